@@ -7,6 +7,14 @@ from flask import (
     url_for,
     request,
     flash,
+    g,
+    jsonify,
+    send_file,
+    stream_template,
+    stream_with_context,
+    Response,
+    before_render_template,
+    template_rendered,
 )
 from flask_login import (
     current_user,
@@ -20,12 +28,227 @@ from flask_wtf import FlaskForm
 from werkzeug.security import check_password_hash, generate_password_hash
 from wtforms import StringField, PasswordField
 from wtforms.validators import DataRequired
+import click
 import pymongo
+import pymongo.monitoring
+from pymongo.write_concern import WriteConcern
 from bson.objectid import ObjectId
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 from datetime import datetime, timedelta
+from urllib.parse import quote
+import bisect
+import itertools
+import csv
+import hmac
+import io
+import os
+import random
+import tempfile
+import threading
+import time
+import openpyxl
+import scheduler
+import shifts
+
+# 耗时直方图的分桶（秒）
+METRICS_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+# 设置后可以用 Authorization: Bearer <METRICS_TOKEN> 读取 /metrics，方便 Prometheus 采集
+METRICS_TOKEN = os.environ.get('METRICS_TOKEN')
+# 超过这个时间（毫秒）的聚合记入慢查询日志，并用 explain 记录扫描的文档数
+SLOW_QUERY_MS = int(os.environ.get('SLOW_QUERY_MS', 500))
+# 同时等待后台 explain 的慢查询最多这么多条，超过的只记日志不 explain，避免慢的时候再给数据库加压
+SLOW_QUERY_EXPLAIN_LIMIT = 4
+# 还没交给后台线程的慢查询最多保留这么多条
+SLOW_QUERY_BACKLOG = 100
+
+class Metrics:
+    """本进程内的计数器和直方图，按 Prometheus 文本格式输出
+
+    多进程部署时每个工作进程各自统计。
+    """
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self._help = {}
+        self._counters = {}  # (名称, 标签) -> 值
+        self._histograms = {}  # (名称, 标签) -> [各分桶计数..., 总和, 次数]
+        # 可重入：TimedCursor 被垃圾回收时可能在本线程持有锁期间记录指标
+        self._lock = threading.RLock()
+
+    def describe(self, name, kind, text):
+        self._help[name] = (kind, text)
+
+    def inc(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def observe(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            data = self._histograms.setdefault(key, [0] * (len(self.buckets) + 2))
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    data[i] += 1
+            data[-2] += value
+            data[-1] += 1
+
+    @staticmethod
+    def _labels(labels, **extra):
+        items = list(labels) + list(extra.items())
+        if not items:
+            return ''
+        escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, value in items)
+        return '{' + ','.join(f'{key}="{value}"' for (key, _), value in zip(items, escaped)) + '}'
+
+    def render(self, gauges=None):
+        """gauges 为 {(名称, 标签元组): 值}，在输出时才取值的指标"""
+        with self._lock:
+            counters = dict(self._counters)
+            histograms = {key: list(value) for key, value in self._histograms.items()}
+        lines = []
+        seen = set()
+        def header(name, default_kind):
+            if name not in seen:
+                seen.add(name)
+                kind, text = self._help.get(name, (default_kind, name))
+                lines.append(f'# HELP {name} {text}')
+                lines.append(f'# TYPE {name} {kind}')
+        for (name, labels), value in sorted((gauges or {}).items()):
+            header(name, 'gauge')
+            lines.append(f'{name}{self._labels(labels)} {value}')
+        for (name, labels), value in sorted(counters.items()):
+            header(name, 'counter')
+            lines.append(f'{name}{self._labels(labels)} {value}')
+        for (name, labels), data in sorted(histograms.items()):
+            header(name, 'histogram')
+            for bound, count in zip(self.buckets, data):
+                lines.append(f'{name}_bucket{self._labels(labels, le=bound)} {count}')
+            lines.append(f'{name}_bucket{self._labels(labels, le="+Inf")} {data[-1]}')
+            lines.append(f'{name}_sum{self._labels(labels)} {data[-2]}')
+            lines.append(f'{name}_count{self._labels(labels)} {data[-1]}')
+        return '\n'.join(lines) + '\n'
+
+metrics = Metrics(METRICS_BUCKETS)
+metrics.describe('http_request_duration_seconds', 'histogram', '每个页面的请求耗时')
+metrics.describe('template_render_duration_seconds', 'histogram', 'Jinja 模板渲染耗时')
+metrics.describe('password_hash_duration_seconds', 'histogram', '密码哈希和校验耗时')
+metrics.describe('mongo_command_duration_seconds', 'histogram', 'MongoDB 命令耗时')
+metrics.describe('mongo_command_failures_total', 'counter', 'MongoDB 命令失败次数')
+metrics.describe('mongo_aggregate_duration_seconds', 'histogram', '查看和统计页面聚合管道的耗时')
+metrics.describe('mongo_docs_examined_total', 'counter', '慢查询 explain 得到的扫描文档数')
+metrics.describe('mongo_slow_queries_total', 'counter', '慢查询次数')
+metrics.describe('report_cache_entries', 'gauge', '统计结果缓存的条数')
+metrics.describe('report_cache_hits_total', 'counter', '统计结果缓存命中次数')
+metrics.describe('report_cache_misses_total', 'counter', '统计结果缓存未命中次数')
+metrics.describe('report_cache_invalidations_total', 'counter', '统计结果缓存因写入失效的次数')
+metrics.describe('schedule_solve_duration_seconds', 'histogram', '排班求解耗时')
+
+def _docs_examined(plan):
+    """执行计划中 totalDocsExamined 的总和"""
+    if isinstance(plan, dict):
+        return sum(value if key == 'totalDocsExamined' and isinstance(value, int) else _docs_examined(value) for key, value in plan.items())
+    if isinstance(plan, list):
+        return sum(_docs_examined(item) for item in plan)
+    return 0
+
+class CommandMetrics(pymongo.monitoring.CommandListener):
+    """记录每个 MongoDB 命令的耗时，explain 命令还记录扫描的文档数"""
+    def __init__(self):
+        self._collections = {}
+
+    def started(self, event):
+        if event.command_name == 'explain':
+            explained = event.command.get('explain', {})
+            self._collections[event.request_id] = explained.get('aggregate') or explained.get('find') or ''
+
+    def succeeded(self, event):
+        metrics.observe('mongo_command_duration_seconds', event.duration_micros / 1e6, command=event.command_name)
+        collection = self._collections.pop(event.request_id, None)
+        if collection is not None:
+            metrics.inc('mongo_docs_examined_total', _docs_examined(event.reply), collection=collection)
+
+    def failed(self, event):
+        self._collections.pop(event.request_id, None)
+        metrics.observe('mongo_command_duration_seconds', event.duration_micros / 1e6, command=event.command_name)
+        metrics.inc('mongo_command_failures_total', command=event.command_name)
+
+# 数据库连接配置，可通过环境变量修改
+MONGO_URI = os.environ.get('MONGO_URI', 'mongodb://localhost:27017/')
+MONGO_MAX_POOL_SIZE = int(os.environ.get('MONGO_MAX_POOL_SIZE', 50))
+MONGO_TIMEOUT_MS = int(os.environ.get('MONGO_TIMEOUT_MS', 5000))
+
+def connect_db():
+    """创建数据库连接，多进程部署时每个工作进程在 fork 之后各自调用一次"""
+    global db
+    db = pymongo.MongoClient(
+        MONGO_URI,
+        maxPoolSize=MONGO_MAX_POOL_SIZE,
+        serverSelectionTimeoutMS=MONGO_TIMEOUT_MS,
+        connectTimeoutMS=MONGO_TIMEOUT_MS,
+        connect=False,  # 第一次使用时才建立连接，fork 之前不会打开任何连接
+        event_listeners=[CommandMetrics()],
+    )
+    return db
 
 # 连接数据库
-db = pymongo.MongoClient('mongodb://localhost:27017/')
+db = connect_db()
+
+# 密码以哈希形式保存，旧的明文密码在下次登录成功时自动转换
+PASSWORD_HASHED = True
+# 写入确认级别，例如 {'w': 1}、{'w': 'majority'}、{'w': 'majority', 'j': True}
+WRITE_CONCERN = {'w': 1}
+# 登录用户缓存的有效时间（秒）
+USER_CACHE_TTL = 300
+# 检查用户表版本号的间隔（秒），多进程部署时其他进程的改动最多延迟这么久生效
+USER_VERSION_CHECK_INTERVAL = 5
+
+_user_cache = {}
+_user_names = {'names': None}  # 下拉框用的用户名列表
+_user_version = {'version': None, 'checked': 0.0}
+_user_cache_lock = threading.Lock()
+
+def is_password_hash(password):
+    """判断保存的密码是否已经是哈希值"""
+    return isinstance(password, str) and password.startswith(('pbkdf2:', 'scrypt:'))
+
+def make_password(password):
+    """生成要保存到数据库的密码"""
+    if PASSWORD_HASHED:
+        start = time.perf_counter()
+        password = generate_password_hash(password)
+        metrics.observe('password_hash_duration_seconds', time.perf_counter() - start, operation='generate')
+    return password
+
+def invalidate_user_cache(user_id=None):
+    """用户表有改动时清除缓存，不传 user_id 则全部清除"""
+    with _user_cache_lock:
+        if user_id is None:
+            _user_cache.clear()
+        else:
+            _user_cache.pop(str(user_id), None)
+
+def user_collection_changed(user_id=None):
+    """增删用户后调用：更新数据库中的用户表版本号，并清除本进程的缓存"""
+    db['app']['meta'].update_one({'_id': 'user_version'}, {'$inc': {'version': 1}}, upsert=True)
+    invalidate_user_cache(user_id)
+    with _user_cache_lock:
+        _user_names['names'] = None
+
+def sync_user_caches():
+    """定期检查用户表版本号，其他进程改动过用户表时清除本进程的缓存"""
+    now = time.monotonic()
+    if now - _user_version['checked'] < USER_VERSION_CHECK_INTERVAL:
+        return
+    find_version = db['app']['meta'].find_one({'_id': 'user_version'})
+    version = find_version['version'] if find_version else 0
+    with _user_cache_lock:
+        _user_version['checked'] = now
+        if version != _user_version['version']:
+            _user_version['version'] = version
+            _user_cache.clear()
+            _user_names['names'] = None
 
 def get_user(user_name):
     """根据用户名获得用户记录"""
@@ -33,15 +256,1291 @@ def get_user(user_name):
     if find_user:
         find_user['id'] = str(find_user['_id'])
         del find_user['_id']
-        find_user['password'] = generate_password_hash(find_user['password'])
         return find_user
     return None
 
+# 各集合的复合索引，对应 view / report / verify 中的查询条件
+INDEXES = {
+    'overtime': [
+        [('verify', pymongo.ASCENDING), ('start_time', pymongo.ASCENDING), ('name', pymongo.ASCENDING)],
+        [('start_time', pymongo.ASCENDING), ('name', pymongo.ASCENDING)],  # 实际加班时间统计不区分是否审核
+        [('name', pymongo.ASCENDING), ('start_time', pymongo.ASCENDING), ('end_time', pymongo.ASCENDING)],  # 时间冲突检查
+    ],
+    'compensation': [
+        [('verify', pymongo.ASCENDING), ('start_time', pymongo.ASCENDING), ('name', pymongo.ASCENDING)],
+        [('name', pymongo.ASCENDING), ('start_time', pymongo.ASCENDING), ('end_time', pymongo.ASCENDING)],
+    ],
+    'writeoff': [
+        [('verify', pymongo.ASCENDING), ('date', pymongo.ASCENDING), ('name', pymongo.ASCENDING)],
+    ],
+    'user': [
+        [('name', pymongo.ASCENDING)],
+    ],
+    'balances': [
+        [('month', pymongo.ASCENDING), ('name', pymongo.ASCENDING)],
+    ],
+}
+
+# 待审核记录的部分索引，只索引 verify 为 False 的记录
+PENDING_INDEXES = {
+    'overtime': [('start_time', pymongo.ASCENDING), ('name', pymongo.ASCENDING)],
+    'compensation': [('start_time', pymongo.ASCENDING), ('name', pymongo.ASCENDING)],
+    'writeoff': [('date', pymongo.ASCENDING), ('name', pymongo.ASCENDING)],
+}
+
+# 审核页面的记录类型和对应的时间字段
+VERIFY_GROUPS = {
+    'overtime': 'start_time',
+    'compensation': 'start_time',
+    'writeoff': 'date',
+}
+# balances 月度汇总表和 user_summary 个人汇总是否已建立，建立后一直有效
+_balances_state = {'ready': False, 'summary': False}
+
+# 已审核记录保留在原集合中的天数，更早的由 archive-records 移到按年份分开的归档集合，如 overtime_2021
+ARCHIVE_AFTER_DAYS = int(os.environ.get('ARCHIVE_AFTER_DAYS', 730))
+# 各进程重新读取归档截止时间的间隔（秒），归档时复制完成后至少等待两个间隔再从原集合删除
+ARCHIVE_CHECK_INTERVAL = 5
+_archive_state = {'cutoff': None, 'first_year': None, 'checked': 0.0}
+
+# 加班和补休每条的时长上限（小时），查找时间冲突时只需向前多查这么久
+MAX_RECORD_HOURS = 12
+# 记录中的时间是否按 UTC 保存。本系统写入的都是不带时区的医院当地时间；由其他程序按 UTC 写入时设为 1，
+# 晚班判断会先换算成 HOSPITAL_TIMEZONE 的当地时间
+RECORDS_IN_UTC = os.environ.get('RECORDS_IN_UTC') == '1'
+# 同一人的时间段不能重叠的集合，加班和补休之间也不能重叠
+INTERVAL_COLLECTIONS = {'overtime': '加班', 'compensation': '补休'}
+# 检查时间冲突到插入完成期间，每人持有 locks 集合中的一个锁文档，多个进程和线程同时提交同一人的记录时依次进行；
+# 等待超过 INTERVAL_LOCK_WAIT 秒放弃，超过 INTERVAL_LOCK_TTL 秒的锁视为进程异常退出后遗留的，可以被接管
+INTERVAL_LOCK_WAIT = 10
+INTERVAL_LOCK_TTL = 30
+
+# 审核页面每类记录每页的条数
+VERIFY_PAGE_SIZE = 30
+
+# 查看页面每页的默认条数和最大条数
+VIEW_PAGE_SIZE = 50
+VIEW_MAX_PAGE_SIZE = 500
+# 查看页面全部显示时每批从数据库读取的条数
+VIEW_STREAM_BATCH_SIZE = 200
+
+# 统计结果缓存的条数和有效时间（秒）
+REPORT_CACHE_SIZE = 128
+REPORT_CACHE_TTL = 600
+# 检查统计结果版本号的间隔（秒），多进程部署时其他进程的写入最多延迟这么久反映到本进程的缓存
+REPORT_VERSION_CHECK_INTERVAL = 5
+
+# 导出文件保存的目录、保留时间（秒）和后台导出的线程数
+EXPORT_DIR = os.path.join(tempfile.gettempdir(), 'endoscopy_exports')
+EXPORT_FILE_TTL = 24 * 3600
+EXPORT_WORKERS = 2
+# 超过这么多行的导出放到后台执行，完成后提供下载链接
+EXPORT_INLINE_LIMIT = 5000
+
+# 导入文件时每批写入的条数，内存占用只与这个数有关，与文件大小无关
+IMPORT_CHUNK_SIZE = 1000
+# 导入文件的表头，中文与查看页面导出的列名一致，也可以直接用字段名
+IMPORT_FIELDS = {
+    '名字': 'name', '开始时间': 'start_time', '结束时间': 'end_time', '班次': 'shift', '房间号': 'room',
+    '日期': 'date', '总时长': 'hours',
+}
+IMPORT_COLLECTIONS = {'overtime': '加班', 'compensation': '补休', 'writeoff': '核销'}
+IMPORT_REQUIRED = {
+    'overtime': ('name', 'start_time', 'end_time'),
+    'compensation': ('name', 'start_time', 'end_time'),
+    'writeoff': ('name', 'date', 'hours'),
+}
+
+# 排班的默认天数，以及计算累计结余的起点（早于所有记录即可）
+SCHEDULE_DAYS = 30
+SCHEDULE_BALANCE_SINCE = datetime(2000, 1, 1)
+
+# 一个请求内并发执行独立查询的线程数，所有请求共用
+QUERY_WORKERS = int(os.environ.get('QUERY_WORKERS', 8))
+
+# 设为 1 时每次聚合前先用 explain 检查是否走了全表扫描
+EXPLAIN_PIPELINES = os.environ.get('EXPLAIN_PIPELINES') == '1'
+
+def ensure_indexes():
+    """创建查询所需的索引，已存在的索引不会重复创建"""
+    created = []
+    for collection, indexes in INDEXES.items():
+        for keys in indexes:
+            created.append(db['app'][collection].create_index(keys))
+    for collection, keys in PENDING_INDEXES.items():
+        created.append(db['app'][collection].create_index(
+            keys,
+            name='pending_' + '_'.join(key for key, _ in keys),
+            partialFilterExpression={'verify': False},
+        ))
+    return created
+
+def _plan_stages(plan):
+    """递归取出执行计划中所有的 stage 名称"""
+    if isinstance(plan, dict):
+        for key, value in plan.items():
+            if key == 'stage':
+                yield value
+            else:
+                yield from _plan_stages(value)
+    elif isinstance(plan, list):
+        for item in plan:
+            yield from _plan_stages(item)
+
+def explain_pipeline(collection, pipeline):
+    """用 explain 检查聚合管道，走全表扫描时给出警告，返回是否使用了索引"""
+    plan = db['app'].command('explain', {'aggregate': collection, 'pipeline': pipeline, 'cursor': {}}, verbosity='queryPlanner')
+    if 'COLLSCAN' in set(_plan_stages(plan)):
+        app.logger.warning('聚合在 %s 上进行了全表扫描(COLLSCAN): %s', collection, pipeline)
+        return False
+    return True
+
+class TimedCursor:
+    """聚合游标的包装，累计第一次执行和之后每次 getMore 取数据的时间（不含调用方处理数据的时间），
+    读完、关闭或被丢弃时记录一次耗时
+
+    超过 SLOW_QUERY_MS 的只放进待处理队列，explain 和写日志由 explain_slow_queries 交给后台线程，
+    被垃圾回收时不会访问数据库。
+    """
+    def __init__(self, collection, pipeline, cursor, elapsed):
+        self.collection = collection
+        self.pipeline = pipeline
+        self.elapsed = elapsed
+        self._cursor = cursor
+        self._recorded = False
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        start = time.perf_counter()
+        try:
+            item = next(self._cursor)
+        except StopIteration:
+            self.elapsed += time.perf_counter() - start
+            self.record()
+            explain_slow_queries()
+            raise
+        self.elapsed += time.perf_counter() - start
+        return item
+
+    def record(self):
+        if self._recorded:
+            return
+        self._recorded = True
+        metrics.observe('mongo_aggregate_duration_seconds', self.elapsed, collection=self.collection)
+        if self.elapsed * 1000 >= SLOW_QUERY_MS:
+            metrics.inc('mongo_slow_queries_total', collection=self.collection)
+            # deque.append 不需要加锁，垃圾回收时调用也是安全的
+            _slow_queries.append((self.collection, self.pipeline, self.elapsed))
+
+    def close(self):
+        self._cursor.close()
+        self.record()
+        explain_slow_queries()
+
+    def __del__(self):
+        # 没有读完就不再使用的游标（如只取第一条，或客户端中途断开的流式下载），
+        # 只记录耗时，慢查询留到下一次 aggregate 时再交给后台线程
+        self.record()
+
+    def __getattr__(self, name):
+        return getattr(self._cursor, name)
+
+def aggregate(collection, pipeline, **kwargs):
+    """执行聚合管道，返回 TimedCursor，整个读取过程的耗时计入指标和慢查询日志"""
+    explain_slow_queries()
+    if EXPLAIN_PIPELINES:
+        explain_pipeline(collection, pipeline)
+    start = time.perf_counter()
+    cursor = db['app'][collection].aggregate(pipeline, **kwargs)
+    return TimedCursor(collection, pipeline, cursor, time.perf_counter() - start)
+
+_slow_queries = deque(maxlen=SLOW_QUERY_BACKLOG)  # 待处理的慢查询 (集合, 管道, 耗时)
+_slow_query_slots = threading.BoundedSemaphore(SLOW_QUERY_EXPLAIN_LIMIT)
+slow_query_executor = ThreadPoolExecutor(max_workers=1)
+
+def log_slow_query(collection, pipeline, elapsed, explain=True):
+    """慢查询日志，explain 为 True 时附带 explain 得到的扫描文档数（explain 会重新执行一次聚合）"""
+    docs_examined = None
+    if explain:
+        try:
+            plan = db['app'].command('explain', {'aggregate': collection, 'pipeline': pipeline, 'cursor': {}}, verbosity='executionStats')
+            docs_examined = _docs_examined(plan)
+        except Exception:  # 慢查询日志不能影响请求本身
+            pass
+    app.logger.warning('慢查询 %s %.0fms 扫描文档数 %s: %s', collection, elapsed * 1000, docs_examined, pipeline)
+
+def _log_slow_query_in_background(collection, pipeline, elapsed):
+    try:
+        log_slow_query(collection, pipeline, elapsed)
+    finally:
+        _slow_query_slots.release()
+
+def explain_slow_queries():
+    """把待处理的慢查询交给后台线程 explain 并写日志，后台积压太多时只写日志"""
+    while _slow_queries:
+        try:
+            collection, pipeline, elapsed = _slow_queries.popleft()
+        except IndexError:
+            return
+        if _slow_query_slots.acquire(blocking=False):
+            slow_query_executor.submit(_log_slow_query_in_background, collection, pipeline, elapsed)
+        else:
+            log_slow_query(collection, pipeline, elapsed, explain=False)
+
+query_executor = ThreadPoolExecutor(max_workers=QUERY_WORKERS)
+
+def _aggregate_list(collection, pipeline):
+    return list(aggregate(collection, pipeline))
+
+def run_queries(queries):
+    """在线程池中并发执行相互独立的聚合 [(集合, 管道)]，按传入的顺序返回各自的结果列表"""
+    if len(queries) == 1:
+        return [_aggregate_list(*queries[0])]
+    futures = [query_executor.submit(_aggregate_list, collection, pipeline) for collection, pipeline in queries]
+    return [future.result() for future in futures]
+
+def name_filter(name):
+    """名字筛选条件，未选择时不筛选"""
+    if not name or name == '未选择':
+        return {}
+    return {'name': name}
+
+def month_start(date):
+    """所在月份的第一天"""
+    return datetime(date.year, date.month, 1)
+
+def next_month(date):
+    """下个月的第一天"""
+    return datetime(date.year + date.month // 12, date.month % 12 + 1, 1)
+
+def split_months(date1, date2):
+    """把 [date1, date2) 分为中间的整月和首尾不足一个月的零散区间，返回 (整月开始, 整月结束, 零散区间)"""
+    first = date1 if date1 == month_start(date1) else next_month(date1)
+    last = month_start(date2)
+    if first >= last:
+        return None, None, [(date1, date2)]
+    ranges = []
+    if date1 < first:
+        ranges.append((date1, first))
+    if last < date2:
+        ranges.append((last, date2))
+    return first, last, ranges
+
+def ranges_match(field, ranges):
+    """时间字段落在任一区间内的筛选条件"""
+    if not ranges:
+        return {field: {'$in': []}}
+    if len(ranges) == 1:
+        return {field: {'$gte': ranges[0][0], '$lt': ranges[0][1]}}
+    return {'$or': [{field: {'$gte': date1, '$lt': date2}} for date1, date2 in ranges]}
+
+def archive_name(collection, year):
+    """归档集合的名字"""
+    return f'{collection}_{year}'
+
+def archive_cutoff():
+    """归档截止时间，此前已审核的记录都在归档集合中，未归档过时为 None"""
+    now = time.monotonic()
+    if now - _archive_state['checked'] >= ARCHIVE_CHECK_INTERVAL:
+        state = db['app']['meta'].find_one({'_id': 'archive'}) or {}
+        if state.get('cutoff') is not None and state.get('first_year') is None:
+            # 早期的归档没有记录 first_year，按已有的归档集合补上
+            state['first_year'] = archived_first_year()
+            if state['first_year'] is not None:
+                db['app']['meta'].update_one({'_id': 'archive'}, {'$min': {'first_year': state['first_year']}})
+        _archive_state['cutoff'] = state.get('cutoff')
+        _archive_state['first_year'] = state.get('first_year')
+        _archive_state['checked'] = now
+    return _archive_state['cutoff']
+
+def with_archives(collection, date1, date2, stages):
+    """在 collection 上执行筛选阶段 stages，时间范围早于归档截止时间时用 $unionWith 合并对应年份的归档集合
+
+    原集合只取截止时间以后的已审核记录，归档集合只取截止时间以前的，用的是本进程读到的截止时间。
+    下一次归档把新的一段复制进归档集合、还没从原集合删除时，不论进程读到的是新的还是旧的截止时间，每条记录都只统计一次。
+    """
+    cutoff = archive_cutoff()
+    if cutoff is None or date1 >= cutoff or collection not in VERIFY_GROUPS:
+        return stages
+    time_field = VERIFY_GROUPS[collection]
+    pipeline = [{'$match': {'$or': [{'verify': {'$ne': True}}, {time_field: {'$gte': cutoff}}]}}, *stages]
+    archived = [{'$match': {time_field: {'$lt': cutoff}}}, *stages]
+    # 只合并实际存在的年份，从很早开始的范围（如累计结余）不会产生大量空的 $unionWith
+    last = min(date2, cutoff) - timedelta(microseconds=1)
+    for year in range(max(date1.year, _archive_state['first_year'] or date1.year), last.year + 1):
+        pipeline.append({'$unionWith': {'coll': archive_name(collection, year), 'pipeline': archived}})
+    return pipeline
+
+def balance_pipeline(date1, date2, weights, name=None, digits=None):
+    """按 weights 加权汇总已审核的加班、补休、核销时长，在 weights 的第一个集合上执行
+
+    整月部分从 balances 月度汇总表读取，首尾不足一个月的部分才扫描原始记录。
+    """
+    use_balances = balances_ready()
+    first, last, ranges = split_months(date1, date2) if use_balances else (None, None, [(date1, date2)])
+
+    def branch(collection):
+        weight = weights[collection]
+        stages = [
+            {'$match': {**ranges_match(VERIFY_GROUPS[collection], ranges), 'verify': True, **name_filter(name)}},
+            {'$project': {'_id': 0, 'name': 1, 'hours': {'$multiply': ['$hours', weight]}}},
+        ]
+        # 零散区间按时间先后排列，涉及的归档年份由首尾决定
+        return with_archives(collection, ranges[0][0], ranges[-1][1], stages) if ranges else stages
+
+    collections = list(weights)
+    pipeline = branch(collections[0])
+    for collection in collections[1:]:
+        pipeline.append({'$unionWith': {'coll': collection, 'pipeline': branch(collection)}})
+    if first is not None:
+        pipeline.append({'$unionWith': {'coll': 'balances', 'pipeline': [
+            {'$match': {'month': {'$gte': first, '$lt': last}, **name_filter(name)}},
+            {'$project': {'_id': 0, 'name': 1, 'hours': {'$add': [
+                {'$multiply': [{'$ifNull': ['$' + collection, 0]}, weight]} for collection, weight in weights.items()
+            ]}}},
+        ]}})
+    pipeline.append({'$group': {'_id': '$name', 'hours_count': {'$sum': '$hours'}}})
+    if digits is not None:
+        pipeline.append({'$set': {'hours_count': {'$round': ['$hours_count', digits]}}})
+    pipeline.append({'$sort': {'hours_count': -1, '_id': 1}})
+    return pipeline
+
+def adjusted_overtime_pipeline(date1, date2, name=None):
+    """调整后加班时间：加班 - 补休 - 核销，一次聚合得到每人结余并排序"""
+    return balance_pipeline(date1, date2, {'overtime': 1, 'compensation': -1, 'writeoff': -1}, name, digits=1)
+
+def writeoff_pipeline(date1, date2, name=None):
+    """核销时间：每人已审核的核销时长"""
+    return balance_pipeline(date1, date2, {'writeoff': 1}, name)
+
+# 晚班次数统计的类型和对应的下班时间，None 表示由表单中的 cutoff_hour 指定
+LATE_SHIFT_REPORTS = {
+    '17点以后加班次数统计': 17,
+    '22点以后加班次数统计': 22,
+    '晚班加班次数统计': None,
+}
+
+def record_timezone():
+    """shifts.classify 的 tz 参数"""
+    return shifts.HOSPITAL_TIMEZONE if RECORDS_IN_UTC else None
+
+def date_part(operator, field):
+    """取日期字段的某一部分，记录按 UTC 保存时按 HOSPITAL_TIMEZONE 的当地时间取"""
+    if RECORDS_IN_UTC:
+        return {operator: {'date': field, 'timezone': shifts.HOSPITAL_TIMEZONE.key}}
+    return {operator: field}
+
+def late_shift_pipeline(date1, date2, cutoff_hour, name=None):
+    """晚班次数：跨天、cutoff_hour 点以后下班或 8 点以前上班的加班各计一次
+
+    判断规则与 shifts.classify 相同，在数据库中完成，只返回每人的次数。
+    """
+    end_seconds = {'$add': [
+        {'$multiply': [date_part('$hour', '$end_time'), 3600]},
+        {'$multiply': [date_part('$minute', '$end_time'), 60]},
+        date_part('$second', '$end_time'),
+        {'$divide': [date_part('$millisecond', '$end_time'), 1000]},
+    ]}
+    same_day = {'$and': [
+        {'$eq': [date_part('$year', '$start_time'), date_part('$year', '$end_time')]},
+        {'$eq': [date_part('$month', '$start_time'), date_part('$month', '$end_time')]},
+        {'$eq': [date_part('$dayOfMonth', '$start_time'), date_part('$dayOfMonth', '$end_time')]},
+    ]}
+    is_late = {'$cond': [
+        same_day,
+        {'$or': [
+            {'$gt': [end_seconds, cutoff_hour * 3600]},
+            {'$lt': [date_part('$hour', '$start_time'), shifts.EARLY_HOUR]},
+        ]},
+        True,
+    ]}
+    return [
+        *with_archives('overtime', date1, date2, [
+            {'$match': {'start_time': {'$gte': date1, '$lt': date2}, 'verify': True, **name_filter(name)}},
+            {'$match': {'$expr': is_late}},
+        ]),
+        {'$group': {'_id': '$name', 'count': {'$sum': 1}}},
+        {'$sort': {'count': -1, '_id': 1}},
+    ]
+
+# 统计页面支持的类型
+REPORT_TYPES = ['实际加班时间统计', '调整后加班时间统计', *LATE_SHIFT_REPORTS, '核销时间统计']
+
+def actual_overtime_pipeline(date1, date2, name=None):
+    """实际加班时间：每人加班时长的总和（含未审核的记录）"""
+    return [
+        *with_archives('overtime', date1, date2, [{
+            '$match': {
+                'start_time': {
+                    '$gte': date1,
+                    '$lt': date2
+                },
+                **name_filter(name),
+            }
+        }]), {
+            '$group': {
+                '_id': '$name',
+                'hours_count': {'$sum': '$hours'},
+            }
+        }, {
+            '$sort': {
+                'hours_count': -1
+            }
+        }
+    ]
+
+def report_pipeline(query_type, date1, date2, name=None, cutoff_hour=None):
+    """统计类型对应的 (集合, 聚合管道)"""
+    if query_type == '实际加班时间统计':
+        return 'overtime', actual_overtime_pipeline(date1, date2, name)
+    elif query_type == '调整后加班时间统计':
+        return 'overtime', adjusted_overtime_pipeline(date1, date2, name)
+    elif query_type in LATE_SHIFT_REPORTS:
+        return 'overtime', late_shift_pipeline(date1, date2, cutoff_hour, name)
+    elif query_type == '核销时间统计':
+        return 'writeoff', writeoff_pipeline(date1, date2, name)
+
+def build_report(query_type, date1, date2, name=None, cutoff_hour=None):
+    """计算统计结果，返回 (表头, 表格内容)"""
+    aggr = aggregate(*report_pipeline(query_type, date1, date2, name, cutoff_hour))
+    if query_type == '实际加班时间统计':
+        return ['名字', '时长'], [[item['_id'], round(item['hours_count'],1)] for item in aggr]
+    elif query_type in LATE_SHIFT_REPORTS:
+        return ['名字', '次数'], [[item['_id'], item['count']] for item in aggr]
+    else:
+        return ['名字', '时长'], [[item['_id'], item['hours_count']] for item in aggr]
+
+class ReportCache:
+    """统计结果缓存，按最近使用淘汰，超过有效时间失效
+
+    本进程的写入由 reports_changed 立即删除受影响的缓存；多进程部署时其他进程的写入
+    通过 meta 中各月份的版本号，由 sync_report_cache 最多 REPORT_VERSION_CHECK_INTERVAL 秒后删除。
+    """
+    def __init__(self, max_size, ttl):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+        self._entries = OrderedDict()  # key -> (过期时间, 开始日期, 结束日期, 结果)
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] <= time.monotonic():
+                self._entries.pop(key, None)
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[3]
+
+    def put(self, key, date1, date2, value):
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.ttl, date1, date2, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, spans):
+        """删除日期区间 [date1, date2) 与任一改动记录的时间范围 (first, last) 有重叠的缓存"""
+        spans = list(spans)
+        if not spans:
+            return
+        with self._lock:
+            for key, entry in list(self._entries.items()):
+                if any(first < entry[2] and last >= entry[1] for first, last in spans):
+                    del self._entries[key]
+                    self.invalidations += 1
+
+    def stats(self):
+        with self._lock:
+            return {
+                'size': len(self._entries),
+                'hits': self.hits,
+                'misses': self.misses,
+                'invalidations': self.invalidations,
+            }
+
+report_cache = ReportCache(REPORT_CACHE_SIZE, REPORT_CACHE_TTL)
+_report_versions = {'months': None, 'checked': 0.0}  # 上次读到的各月份版本号
+
+def span_months(first, last):
+    """时间范围 [first, last] 经过的各月份的第一天"""
+    month = month_start(first)
+    while month <= last:
+        yield month
+        month = next_month(month)
+
+def reports_changed(spans):
+    """记录有改动时调用：删除本进程中时间范围与 spans 重叠的统计结果缓存，并更新受影响月份的版本号"""
+    spans = list(spans)
+    if not spans:
+        return
+    report_cache.invalidate(spans)
+    months = {month.strftime('%Y-%m') for first, last in spans for month in span_months(first, last)}
+    db['app']['meta'].update_one({'_id': 'report_version'}, {'$inc': {f'months.{month}': 1 for month in months}}, upsert=True)
+
+def sync_report_cache():
+    """定期检查各月份的版本号，其他进程改动过的月份删除本进程中对应的统计结果缓存"""
+    now = time.monotonic()
+    if now - _report_versions['checked'] < REPORT_VERSION_CHECK_INTERVAL:
+        return
+    find_version = db['app']['meta'].find_one({'_id': 'report_version'})
+    months = find_version.get('months', {}) if find_version else {}
+    previous = _report_versions['months']
+    _report_versions['months'] = months
+    _report_versions['checked'] = now
+    if previous is None:
+        # 第一次检查前的缓存无法判断是否过期
+        report_cache.invalidate([(datetime.min, datetime.max)])
+        return
+    changed = [datetime.strptime(month, '%Y-%m') for month, version in months.items() if previous.get(month) != version]
+    report_cache.invalidate((month, next_month(month) - timedelta(microseconds=1)) for month in changed)
+
+# 查看结果导出的列
+VIEW_EXPORT_COLUMNS = {
+    'overtime': [('名字', 'name'), ('开始时间', 'start_time'), ('结束时间', 'end_time'), ('总时长', 'hours'), ('班次', 'shift'), ('房间号', 'room'), ('时段', 'period')],
+    'compensation': [('名字', 'name'), ('开始时间', 'start_time'), ('结束时间', 'end_time'), ('总时长', 'hours')],
+    'writeoff': [('名字', 'name'), ('日期', 'date'), ('总时长', 'hours')],
+}
+
+export_executor = ThreadPoolExecutor(max_workers=EXPORT_WORKERS)
+
+def view_export_rows(query_type, items):
+    """查看结果的导出行，第一行是表头；加班的时段按每批 VIEW_STREAM_BATCH_SIZE 条判断"""
+    columns = VIEW_EXPORT_COLUMNS[query_type]
+    yield [title for title, _ in columns]
+    items = iter(items)
+    while True:
+        batch = list(itertools.islice(items, VIEW_STREAM_BATCH_SIZE))
+        if not batch:
+            break
+        if query_type == 'overtime':
+            periods = shifts.classify([item['start_time'] for item in batch], [item['end_time'] for item in batch], tz=record_timezone())
+            for item, period in zip(batch, periods):
+                item['period'] = shifts.LABELS[int(period)]
+        for item in batch:
+            row = [item.get(field, '') for _, field in columns]
+            yield [round(value, 1) if field == 'hours' else value for value, (_, field) in zip(row, columns)]
+
+def iter_csv(rows):
+    """逐行生成 CSV 文本，带 BOM 以便 Excel 正确识别中文"""
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    yield '\ufeff'
+    for i, row in enumerate(rows, 1):
+        writer.writerow(row)
+        if i % 500 == 0:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+    yield buffer.getvalue()
+
+def write_xlsx(rows, file):
+    """逐行写入 Excel 文件，write_only 模式下不在内存中保存整张表"""
+    workbook = openpyxl.Workbook(write_only=True)
+    sheet = workbook.create_sheet()
+    for row in rows:
+        sheet.append(row)
+    workbook.save(file)
+
+def export_response(rows, export_format, filename):
+    """直接在本次请求中返回导出文件"""
+    if export_format == 'xlsx':
+        buffer = io.BytesIO()
+        write_xlsx(rows, buffer)
+        buffer.seek(0)
+        return send_file(buffer, as_attachment=True, download_name=filename + '.xlsx')
+    return Response(
+        stream_with_context(iter_csv(rows)),
+        mimetype='text/csv',
+        headers={'Content-Disposition': "attachment; filename*=UTF-8''" + quote(filename + '.csv')},
+    )
+
+def _run_export(job_id, rows_factory, export_format, path):
+    """在后台线程中生成导出文件"""
+    try:
+        if export_format == 'xlsx':
+            write_xlsx(rows_factory(), path)
+        else:
+            with open(path, 'w', encoding='utf-8', newline='') as file:
+                for chunk in iter_csv(rows_factory()):
+                    file.write(chunk)
+        db['app']['exports'].update_one({'_id': job_id}, {'$set': {'status': 'done', 'finished_at': datetime.now()}})
+    except Exception as e:
+        app.logger.exception('导出失败')
+        db['app']['exports'].update_one({'_id': job_id}, {'$set': {'status': 'failed', 'error': str(e)}})
+
+def cleanup_exports():
+    """删除过期的导出文件和记录"""
+    expired = datetime.now() - timedelta(seconds=EXPORT_FILE_TTL)
+    for job in db['app']['exports'].find({'created_at': {'$lt': expired}}, {'path': 1}):
+        if os.path.exists(job['path']):
+            os.remove(job['path'])
+    db['app']['exports'].delete_many({'created_at': {'$lt': expired}})
+
+def submit_export(rows_factory, export_format, filename, owner):
+    """把导出任务交给后台线程池，返回任务 ID；rows_factory 在后台线程中调用，逐行产生数据"""
+    cleanup_exports()
+    os.makedirs(EXPORT_DIR, exist_ok=True)
+    job_id = ObjectId()
+    path = os.path.join(EXPORT_DIR, f'{job_id}.{export_format}')
+    db['app']['exports'].insert_one({
+        '_id': job_id,
+        'status': 'running',
+        'path': path,
+        'filename': f'{filename}.{export_format}',
+        'owner': owner,
+        'created_at': datetime.now(),
+    })
+    export_executor.submit(_run_export, job_id, rows_factory, export_format, path)
+    return job_id
+
+def parse_verify_filters(args):
+    """解析审核页面的筛选条件，返回 (类型, 名字, 开始日期, 结束日期)"""
+    group = args.get('group', '全部')
+    name = args.get('name', '未选择')
+    date1 = args.get('date1', '')
+    date2 = args.get('date2', '')
+    try:
+        start = datetime.strptime(date1, '%Y-%m-%d') if date1 else None
+        end = datetime.strptime(date2, '%Y-%m-%d') + timedelta(days=1) if date2 else None
+    except ValueError:
+        flash('日期输入有误！')
+        start = end = None
+    return group, name, start, end
+
+def pending_match(collection, name=None, date1=None, date2=None):
+    """待审核记录的筛选条件"""
+    time_field = VERIFY_GROUPS[collection]
+    match = {'verify': False, **name_filter(name)}
+    if date1 or date2:
+        match[time_field] = {}
+        if date1:
+            match[time_field]['$gte'] = date1
+        if date2:
+            match[time_field]['$lt'] = date2
+    return match
+
+def pending_pipeline(collection, name=None, date1=None, date2=None, page=1):
+    """待审核记录的一页，按时间从早到晚，多取一条用于判断是否还有下一页"""
+    time_field = VERIFY_GROUPS[collection]
+    return [
+        {'$match': pending_match(collection, name, date1, date2)},
+        {'$sort': {time_field: 1, '_id': 1}},
+        {'$skip': (page - 1) * VERIFY_PAGE_SIZE},
+        {'$limit': VERIFY_PAGE_SIZE + 1},
+    ]
+
+def add_to_balances(collection, match, source=None, from_pending=False):
+    """把 source（默认为 collection）中符合 match 的记录按人和月份累加到 balances 月度汇总表和 user_summary，返回各组记录的时间范围
+
+    from_pending 为 True 表示这些记录刚审核通过，同时减少 user_summary 中的待审核条数。
+    """
+    time_field = VERIFY_GROUPS[collection]
+    aggr = db['app'][source or collection].aggregate([
+        {'$match': match},
+        {'$group': {
+            '_id': {
+                'name': '$name',
+                'month': {'$dateFromParts': {'year': {'$year': '$' + time_field}, 'month': {'$month': '$' + time_field}}},
+            },
+            'hours': {'$sum': '$hours'},
+            'count': {'$sum': 1},
+            'first': {'$min': '$' + time_field},
+            'last': {'$max': '$' + time_field},
+        }},
+    ])
+    aggr = list(aggr)
+    operations = [
+        pymongo.UpdateOne(
+            {'name': item['_id']['name'], 'month': item['_id']['month']},
+            {'$inc': {collection: item['hours']}},
+            upsert=True,
+        ) for item in aggr
+    ]
+    if operations:
+        db['app']['balances'].bulk_write(operations, ordered=False)
+    summary = [
+        pymongo.UpdateOne({'_id': item['_id']['name']}, {'$inc': {
+            'total.' + collection: item['hours'],
+            f"months.{item['_id']['month']:%Y-%m}.{collection}": item['hours'],
+            **({'pending.' + collection: -item['count']} if from_pending else {}),
+        }}, upsert=True) for item in aggr
+    ]
+    if summary:
+        db['app']['user_summary'].bulk_write(summary, ordered=False)
+    return [(item['first'], item['last']) for item in aggr]
+
+def update_pending(collection, records, sign=1):
+    """按人增减 user_summary 中的待审核条数"""
+    if collection not in VERIFY_GROUPS:
+        return
+    counts = {}
+    for record in records:
+        counts[record['name']] = counts.get(record['name'], 0) + sign
+    operations = [
+        pymongo.UpdateOne({'_id': name}, {'$inc': {'pending.' + collection: count}}, upsert=True)
+        for name, count in counts.items()
+    ]
+    if operations:
+        db['app']['user_summary'].bulk_write(operations, ordered=False)
+
+def rebuild_pending(collection):
+    """重新统计 user_summary 中每人 collection 的待审核条数"""
+    db['app']['user_summary'].update_many({}, {'$unset': {'pending.' + collection: ''}})
+    pending = db['app'][collection].aggregate([
+        {'$match': {'verify': False}},
+        {'$group': {'_id': '$name', 'count': {'$sum': 1}}},
+    ])
+    operations = [
+        pymongo.UpdateOne({'_id': item['_id']}, {'$set': {'pending.' + collection: item['count']}}, upsert=True)
+        for item in pending
+    ]
+    if operations:
+        db['app']['user_summary'].bulk_write(operations, ordered=False)
+
+def get_user_summary(name):
+    """个人首页的汇总：本月已审核的加班和补休时长、总结余和待审核条数，user_summary 未建立时返回 None"""
+    if not summary_ready():
+        return None
+    month = datetime.now().strftime('%Y-%m')
+    summary = db['app']['user_summary'].find_one({'_id': name}, {'total': 1, 'pending': 1, 'months.' + month: 1}) or {}
+    total = summary.get('total', {})
+    this_month = summary.get('months', {}).get(month, {})
+    return {
+        'overtime': round(this_month.get('overtime', 0), 1),
+        'compensation': round(this_month.get('compensation', 0), 1),
+        'balance': round(total.get('overtime', 0) - total.get('compensation', 0) - total.get('writeoff', 0), 1),
+        'pending': sum(summary.get('pending', {}).values()),
+    }
+
+def confirm_records(collection, match):
+    """审核通过符合 match 的待审核记录，并更新 balances，返回通过的条数"""
+    # 先给这次审核的记录打上标记，只把真正被本次改动的记录计入汇总表
+    token = ObjectId()
+    result = db['app'][collection].update_many({**match, 'verify': False}, {'$set': {'verify': True, 'confirm_token': token}})
+    if result.modified_count:
+        reports_changed(add_to_balances(collection, {'confirm_token': token}, from_pending=True))
+        # 审核通过的记录早于归档截止时间时直接移到归档集合
+        cutoff = archive_cutoff()
+        if cutoff is not None:
+            move_to_archive(collection, {'confirm_token': token, VERIFY_GROUPS[collection]: {'$lt': cutoff}})
+        db['app'][collection].update_many({'confirm_token': token}, {'$unset': {'confirm_token': ''}})
+    return result.modified_count
+
+def archive_collections(collection):
+    """collection 已有的归档集合名"""
+    return sorted(db['app'].list_collection_names(filter={'name': {'$regex': f'^{collection}_[0-9]{{4}}$'}}))
+
+def archived_first_year():
+    """已有归档集合中最早的年份，没有归档集合时为 None"""
+    years = [int(name.rsplit('_', 1)[1]) for collection in VERIFY_GROUPS for name in archive_collections(collection)]
+    return min(years) if years else None
+
+def copy_to_archive(collection, match):
+    """把 collection 中符合 match 的记录按年份复制到归档集合，返回标记这批记录的 archive_token"""
+    time_field = VERIFY_GROUPS[collection]
+    # 先打上标记，之后只删除确实复制过的记录
+    token = ObjectId()
+    db['app'][collection].update_many(match, {'$set': {'archive_token': token}})
+    years = [item['_id'] for item in db['app'][collection].aggregate([
+        {'$match': {'archive_token': token}},
+        {'$group': {'_id': {'$year': '$' + time_field}}},
+    ])]
+    for year in years:
+        target = archive_name(collection, year)
+        db['app'][collection].aggregate([
+            {'$match': {'archive_token': token, time_field: {'$gte': datetime(year, 1, 1), '$lt': datetime(year + 1, 1, 1)}}},
+            {'$project': {'archive_token': 0, 'confirm_token': 0}},
+            {'$merge': {'into': target, 'on': '_id', 'whenMatched': 'replace', 'whenNotMatched': 'insert'}},
+        ])
+        db['app'][target].create_index([(time_field, pymongo.ASCENDING), ('name', pymongo.ASCENDING)])
+        update_archive_summary(collection, year)
+    if years:
+        db['app']['meta'].update_one({'_id': 'archive'}, {'$min': {'first_year': min(years)}}, upsert=True)
+    return token
+
+def move_to_archive(collection, match):
+    """把 collection 中符合 match 的记录移到归档集合，返回移动的条数"""
+    token = copy_to_archive(collection, match)
+    return db['app'][collection].delete_many({'archive_token': token}).deleted_count
+
+def update_archive_summary(collection, year):
+    """重新计算一个归档集合中每人的记录条数和总时长，写入 archive_summary"""
+    aggr = db['app'][archive_name(collection, year)].aggregate([
+        {'$group': {'_id': '$name', 'count': {'$sum': 1}, 'hours': {'$sum': '$hours'}}},
+    ])
+    operations = [
+        pymongo.ReplaceOne(
+            {'collection': collection, 'year': year, 'name': item['_id']},
+            {'collection': collection, 'year': year, 'name': item['_id'], 'count': item['count'], 'hours': item['hours']},
+            upsert=True,
+        ) for item in aggr
+    ]
+    if operations:
+        db['app']['archive_summary'].bulk_write(operations, ordered=False)
+
+def archive_records(cutoff):
+    """把 cutoff 以前已审核的记录移到归档集合，截止时间只能往后移，返回各集合移动的条数
+
+    先复制并公布新的截止时间，等所有进程都读到以后再从原集合删除。with_archives 按各进程读到的截止时间
+    划分原集合和归档集合，期间的查询既不会漏掉也不会重复统计。
+    """
+    state = db['app']['meta'].find_one({'_id': 'archive'}) or {}
+    if state.get('cutoff') and state['cutoff'] > cutoff:
+        cutoff = state['cutoff']
+    tokens = {
+        collection: copy_to_archive(collection, {'verify': True, time_field: {'$lt': cutoff}})
+        for collection, time_field in VERIFY_GROUPS.items()
+    }
+    db['app']['meta'].update_one({'_id': 'archive'}, {'$set': {'cutoff': cutoff, 'archived_at': datetime.now()}}, upsert=True)
+    _archive_state['checked'] = 0.0
+    time.sleep(ARCHIVE_CHECK_INTERVAL * 2 + 1)
+    moved = {}
+    for collection, time_field in VERIFY_GROUPS.items():
+        moved[collection] = db['app'][collection].delete_many({'archive_token': tokens[collection]}).deleted_count
+        # 复制期间由还不知道新截止时间的进程审核通过的记录
+        moved[collection] += move_to_archive(collection, {'verify': True, time_field: {'$lt': cutoff}})
+    return moved
+
+def rebuild_balances():
+    """根据所有记录重建 balances 月度汇总表和 user_summary 个人汇总"""
+    db['app']['balances'].delete_many({})
+    db['app']['user_summary'].delete_many({})
+    for collection in VERIFY_GROUPS:
+        add_to_balances(collection, {'verify': True})
+        for archive in archive_collections(collection):
+            add_to_balances(collection, {}, source=archive)
+        rebuild_pending(collection)
+    # summary 标记 user_summary 也已建立，只建立过 balances 的旧数据需要重新运行一次
+    db['app']['meta'].update_one({'_id': 'balances'}, {'$set': {'built': True, 'summary': True, 'built_at': datetime.now()}}, upsert=True)
+    _balances_state['ready'] = True
+    _balances_state['summary'] = True
+
+def balances_ready():
+    """balances 是否已经建立，未建立时统计全部从原始记录计算"""
+    if not _balances_state['ready']:
+        _balances_state['ready'] = db['app']['meta'].count_documents({'_id': 'balances', 'built': True}) == 1
+    return _balances_state['ready']
+
+def summary_ready():
+    """user_summary 是否已经建立，在 balances 之后加入，旧的部署重新运行 rebuild-balances 之后才有"""
+    if not _balances_state['summary']:
+        _balances_state['summary'] = db['app']['meta'].count_documents({'_id': 'balances', 'built': True, 'summary': True}) == 1
+    return _balances_state['summary']
+
+def invalidate_reports(collection, records):
+    """记录有改动时，删除时间范围包含这些记录的统计结果缓存"""
+    if collection in VERIFY_GROUPS:
+        time_field = VERIFY_GROUPS[collection]
+        reports_changed((record[time_field], record[time_field]) for record in records)
+
+def get_collection(collection):
+    """获取按 WRITE_CONCERN 写入的集合"""
+    return db['app'].get_collection(collection, write_concern=WriteConcern(**WRITE_CONCERN))
+
+def find_conflicts(records):
+    """检查待插入的加班或补休记录是否与同一人已有的或同批的加班、补休重叠，返回 [(序号, 说明)]
+
+    每个集合只查询一次，每人一个 $or 分支，走 (name, start_time, end_time) 索引；
+    已有记录不超过 MAX_RECORD_HOURS，所以只需查开始时间在新记录开始前 MAX_RECORD_HOURS 以内的记录。
+    """
+    ranges = {}
+    for record in records:
+        first, last = ranges.get(record['name'], (record['start_time'], record['end_time']))
+        ranges[record['name']] = (min(first, record['start_time']), max(last, record['end_time']))
+    if not ranges:
+        return []
+    lookback = timedelta(hours=MAX_RECORD_HOURS)
+    query = {'$or': [
+        {'name': name, 'start_time': {'$gt': first - lookback, '$lt': last}, 'end_time': {'$gt': first}}
+        for name, (first, last) in ranges.items()
+    ]}
+    earliest = min(first for first, _ in ranges.values()) - lookback
+    cutoff = archive_cutoff()
+    existing = {}
+    for collection, label in INTERVAL_COLLECTIONS.items():
+        sources = [collection]
+        if cutoff is not None and earliest < cutoff:
+            sources += [archive_name(collection, year) for year in range(max(earliest.year, _archive_state['first_year'] or earliest.year), cutoff.year + 1)]
+        for source in sources:
+            for item in db['app'][source].find(query, {'_id': 0, 'name': 1, 'start_time': 1, 'end_time': 1}):
+                existing.setdefault(item['name'], []).append((item['start_time'], item['end_time'], label))
+
+    conflicts = []
+    # 同批记录之间按人排序后相邻比较
+    by_name = {}
+    for index, record in enumerate(records):
+        by_name.setdefault(record['name'], []).append(index)
+    for name, indexes in by_name.items():
+        indexes.sort(key=lambda index: records[index]['start_time'])
+        intervals = sorted(existing.get(name, []))
+        starts = [start for start, _, _ in intervals]
+        previous = None  # 已接受的记录中结束最晚的一条
+        for index in indexes:
+            start, end = records[index]['start_time'], records[index]['end_time']
+            conflict = None
+            position = bisect.bisect_left(starts, start - lookback)
+            for other_start, other_end, label in intervals[position:bisect.bisect_left(starts, end)]:
+                if other_end > start:
+                    conflict = f"与已有的{label} {other_start:%m-%d %H:%M}~{other_end:%m-%d %H:%M} 重叠"
+                    break
+            if conflict is None and previous is not None and records[previous]['end_time'] > start:
+                conflict = f"与本次提交的 {records[previous]['start_time']:%m-%d %H:%M}~{records[previous]['end_time']:%m-%d %H:%M} 重叠"
+            if conflict is not None:
+                conflicts.append((index, conflict))
+            elif previous is None or end > records[previous]['end_time']:
+                previous = index
+    return sorted(conflicts)
+
+class LockTimeout(Exception):
+    """等待时间段锁超时"""
+
+@contextmanager
+def interval_locks(names):
+    """持有 names 中每人的时间段锁，全部拿到后才进入，拿不到时放开已拿到的稍后重试，不会互相等待"""
+    locks = get_collection('locks')
+    owner = ObjectId()
+    ids = sorted({'interval:' + name for name in names})
+    deadline = time.monotonic() + INTERVAL_LOCK_WAIT
+    while True:
+        now = datetime.now()
+        expires = now + timedelta(seconds=INTERVAL_LOCK_TTL)
+        locks.update_many({'_id': {'$in': ids}, 'expires': {'$lt': now}}, {'$set': {'owner': owner, 'expires': expires}})
+        try:
+            locks.insert_many([{'_id': lock_id, 'owner': owner, 'expires': expires} for lock_id in ids], ordered=False)
+            break
+        except pymongo.errors.BulkWriteError:
+            # 已被别人持有，或者是刚才接管的过期锁
+            if locks.count_documents({'_id': {'$in': ids}, 'owner': owner}) == len(ids):
+                break
+        locks.delete_many({'_id': {'$in': ids}, 'owner': owner})
+        if time.monotonic() > deadline:
+            raise LockTimeout('有其他提交正在处理，请重试')
+        time.sleep(random.uniform(0.02, 0.1))
+    try:
+        yield
+    finally:
+        locks.delete_many({'_id': {'$in': ids}, 'owner': owner})
+
+def insert_interval(collection, record):
+    """插入一条加班或补休，持有此人的锁期间检查时间冲突再插入，返回提示信息"""
+    try:
+        with interval_locks([record['name']]):
+            conflicts = find_conflicts([record])
+            if conflicts:
+                return f"时间{conflicts[0][1]}！"
+            return "数据上传成功！" if insert_record(collection, record) else "数据上传失败，请重试！"
+    except LockTimeout as e:
+        return f'{e}！'
+
+def insert_record(collection, record):
+    """插入一条记录，返回是否成功
+
+    写入失败（重复键、写入确认超时、连接错误等）都会抛出异常，不需要再检查返回结果。
+    WRITE_CONCERN 为 w=0 时服务器不返回确认，写入错误无从得知，发送成功即认为成功。
+    """
+    try:
+        get_collection(collection).insert_one(record)
+    except pymongo.errors.PyMongoError:
+        return False
+    invalidate_reports(collection, [record])
+    if not record.get('verify'):
+        update_pending(collection, [record])
+    return True
+
+def insert_records(collection, records):
+    """批量插入记录，一次往返完成，返回成功条数和失败记录 [(序号, 错误信息)]
+
+    加班和补休在持有涉及的人的锁期间检查时间冲突再插入，冲突的记录不插入，作为失败记录返回。
+    """
+    if not records:
+        return 0, []
+    if collection in INTERVAL_COLLECTIONS:
+        try:
+            with interval_locks(record['name'] for record in records):
+                conflicts = find_conflicts(records)
+                rejected = {index for index, _ in conflicts}
+                kept = [index for index in range(len(records)) if index not in rejected]
+                number_inserted, errors = _insert_many(collection, [records[index] for index in kept])
+        except LockTimeout as e:
+            return 0, [(index, str(e)) for index in range(len(records))]
+        return number_inserted, sorted(conflicts + [(kept[index], errmsg) for index, errmsg in errors])
+    return _insert_many(collection, records)
+
+def _insert_many(collection, records):
+    if not records:
+        return 0, []
+    try:
+        result = get_collection(collection).insert_many(records, ordered=False)
+        invalidate_reports(collection, records)
+        update_pending(collection, [record for record in records if not record.get('verify')])
+        return len(result.inserted_ids), []
+    except pymongo.errors.BulkWriteError as e:
+        invalidate_reports(collection, records)
+        errors = [(error['index'], error['errmsg']) for error in e.details['writeErrors']]
+        failed = {index for index, _ in errors}
+        update_pending(collection, [record for index, record in enumerate(records) if index not in failed and not record.get('verify')])
+        return e.details['nInserted'], errors
+
+def flash_batch_result(records, number_inserted, errors):
+    """提示批量上传的结果"""
+    flash(f'一共{len(records)}条数据，成功上传{number_inserted}条，请去审核界面查看！')
+    for index, errmsg in errors:
+        flash(f"{records[index]['name']}的数据上传失败：{errmsg}")
+
 def get_valid_users_names():
-    usernames = []
-    for item in db['app']['user'].find():
-        usernames.append(item['name'])
-    return usernames
+    """所有用户名，缓存在本进程中，用户表有改动时重新读取"""
+    sync_user_caches()
+    with _user_cache_lock:
+        usernames = _user_names['names']
+    if usernames is None:
+        usernames = [item['name'] for item in db['app']['user'].find({}, {'_id': 0, 'name': 1})]
+        with _user_cache_lock:
+            _user_names['names'] = usernames
+    return list(usernames)
+
+def detect_encoding(path):
+    """CSV 文件的编码，Excel 另存的中文 CSV 通常是 GB18030 兼容的编码"""
+    with open(path, 'rb') as file:
+        head = file.read(65536)
+    try:
+        head.decode('utf-8')
+    except UnicodeDecodeError as e:
+        # 只在末尾截断了一个多字节字符时仍是 UTF-8
+        if e.start < len(head) - 3:
+            return 'gb18030'
+    return 'utf-8-sig'
+
+def read_import_rows(path, file_format):
+    """逐行读出导入文件，生成 (行号, {字段: 值})，第一行是表头，空行跳过"""
+    if file_format == 'xlsx':
+        workbook = openpyxl.load_workbook(path, read_only=True, data_only=True)
+        try:
+            yield from _import_rows(workbook.active.iter_rows(values_only=True))
+        finally:
+            workbook.close()
+    else:
+        with open(path, encoding=detect_encoding(path), newline='') as file:
+            yield from _import_rows(csv.reader(file))
+
+def _import_rows(rows):
+    header = None
+    for number, row in enumerate(rows, 1):
+        if header is None:
+            header = [IMPORT_FIELDS.get(str(title).strip(), str(title).strip()) if title is not None else None for title in row]
+            continue
+        if all(value is None or str(value).strip() == '' for value in row):
+            continue
+        yield number, {field: value for field, value in zip(header, row) if field}
+
+def parse_import_time(value):
+    """Excel 中的时间已经是 datetime，CSV 中的是文本，如 2026-10-01 08:00 或 Excel 的 2026/10/1 8:00"""
+    if isinstance(value, datetime):
+        return value
+    value = str(value or '').strip().replace('/', '-')
+    try:
+        date = datetime.fromisoformat(value)
+    except ValueError:
+        for date_format in ('%Y-%m-%d %H:%M', '%Y-%m-%d %H:%M:%S', '%Y-%m-%d'):
+            try:
+                return datetime.strptime(value, date_format)
+            except ValueError:
+                pass
+        raise ValueError('时间格式有误')
+    if date.tzinfo is not None:
+        raise ValueError('时间不能带时区')
+    return date
+
+def parse_import_row(collection, row, users):
+    """按填写页面的规则检查一行并转换为记录，有误时抛出 ValueError"""
+    name = str(row.get('name') or '').strip()
+    if name not in users:
+        raise ValueError('用户不存在')
+    if collection == 'writeoff':
+        hours = str(row.get('hours') if row.get('hours') is not None else '').strip()
+        if not isNumeric(hours):
+            raise ValueError('时长输入有误')
+        date = parse_import_time(row.get('date'))
+        return {
+            'date': datetime(date.year, date.month, date.day),
+            'name': name,
+            'hours': float(hours),
+            'verify': False,
+        }
+    date1 = parse_import_time(row.get('start_time'))
+    date2 = parse_import_time(row.get('end_time'))
+    if date1 >= date2 or (date2 - date1).days > 0 or (date2 - date1).seconds / 3600 > MAX_RECORD_HOURS:
+        raise ValueError('时间输入有误')
+    record = {
+        'start_time': date1,
+        'end_time': date2,
+        'hours': (date2 - date1).seconds / 3600,
+        'name': name,
+        'verify': False,
+    }
+    if collection == 'overtime':
+        for field in ('shift', 'room'):
+            value = row.get(field)
+            # Excel 中的房间号可能是数字
+            record[field] = str(int(value) if isinstance(value, float) and value.is_integer() else value).strip() if value is not None else ''
+    return record
+
+def import_records(collection, rows, report):
+    """逐行检查 rows 并按 IMPORT_CHUNK_SIZE 分批插入，返回 (总行数, 成功条数)
+
+    每条失败的记录调用一次 report(行号, 名字, 原因)，加班和补休的时间冲突也在这里报告，
+    后面批次的记录会与前面批次已插入的记录比较。
+    """
+    users = set(get_valid_users_names())
+    total = inserted = 0
+    chunk, numbers = [], []
+    for number, row in rows:
+        if not total:
+            missing = [title for title, field in IMPORT_FIELDS.items() if field in IMPORT_REQUIRED[collection] and field not in row]
+            if missing:
+                raise ValueError('缺少列：' + '、'.join(missing))
+        total += 1
+        try:
+            record = parse_import_row(collection, row, users)
+        except ValueError as e:
+            report(number, row.get('name') or '', str(e))
+            continue
+        chunk.append(record)
+        numbers.append(number)
+        if len(chunk) >= IMPORT_CHUNK_SIZE:
+            inserted += _insert_import_chunk(collection, chunk, numbers, report)
+            chunk, numbers = [], []
+    if chunk:
+        inserted += _insert_import_chunk(collection, chunk, numbers, report)
+    return total, inserted
+
+def _insert_import_chunk(collection, chunk, numbers, report):
+    number_inserted, errors = insert_records(collection, chunk)
+    for index, errmsg in errors:
+        report(numbers[index], chunk[index]['name'], errmsg)
+    return number_inserted
+
+def _run_import(job_id, collection, path, file_format, report_path):
+    """在后台线程中导入文件，失败的行写入 report_path，完成后删除上传的文件"""
+    try:
+        with open(report_path, 'w', encoding='utf-8-sig', newline='') as file:
+            writer = csv.writer(file)
+            writer.writerow(['行号', '名字', '原因'])
+            total, inserted = import_records(collection, read_import_rows(path, file_format), lambda *row: writer.writerow(row))
+        db['app']['exports'].update_one({'_id': job_id}, {'$set': {
+            'status': 'done', 'finished_at': datetime.now(), 'total': total, 'inserted': inserted,
+        }})
+    except Exception as e:
+        app.logger.exception('导入失败')
+        db['app']['exports'].update_one({'_id': job_id}, {'$set': {'status': 'failed', 'error': str(e)}})
+    finally:
+        os.remove(path)
+
+def submit_import(upload, collection, owner):
+    """保存上传的文件后交给后台线程导入，返回任务 ID，进度和错误报告在导出页面查看"""
+    cleanup_exports()
+    os.makedirs(EXPORT_DIR, exist_ok=True)
+    job_id = ObjectId()
+    file_format = 'xlsx' if upload.filename.lower().endswith('.xlsx') else 'csv'
+    path = os.path.join(EXPORT_DIR, f'{job_id}.upload.{file_format}')
+    upload.save(path)
+    report_path = os.path.join(EXPORT_DIR, f'{job_id}.csv')
+    db['app']['exports'].insert_one({
+        '_id': job_id,
+        'status': 'running',
+        'path': report_path,
+        'filename': f'{IMPORT_COLLECTIONS[collection]}导入错误报告.csv',
+        'owner': owner,
+        'kind': 'import',
+        'created_at': datetime.now(),
+    })
+    export_executor.submit(_run_import, job_id, collection, path, file_format, report_path)
+    return job_id
+
+def schedule_leave(start, days):
+    """排班期间每人补休的日期 {名字: [date]}"""
+    end = start + timedelta(days=days)
+    leave = {}
+    # 补休不超过 12 小时，前一天开始的也可能跨到排班期间
+    for record in db['app']['compensation'].find(
+        {'verify': {'$in': [True, False]}, 'start_time': {'$gte': start - timedelta(days=1), '$lt': end}},
+        {'_id': 0, 'name': 1, 'start_time': 1, 'end_time': 1},
+    ):
+        day = record['start_time'].date()
+        while day <= record['end_time'].date():
+            leave.setdefault(record['name'], []).append(day)
+            day += timedelta(days=1)
+    return leave
+
+def generate_schedule(start, days, created_by, max_weekly_hours=scheduler.MAX_WEEKLY_HOURS):
+    """按截至 start 的调整后加班时间和排班期间的补休生成排班，保存到 schedules，返回保存的文档"""
+    staff = get_valid_users_names()
+    balances = {item['_id']: item['hours_count'] for item in aggregate('overtime', adjusted_overtime_pipeline(SCHEDULE_BALANCE_SINCE, start))}
+    solver = scheduler.Scheduler(staff, start, days, balances, schedule_leave(start, days), max_weekly_hours=max_weekly_hours)
+    begin = time.perf_counter()
+    solver.solve()
+    elapsed = time.perf_counter() - begin
+    metrics.observe('schedule_solve_duration_seconds', elapsed, mode='full')
+    document = {
+        'start': solver.start,
+        'days': days,
+        'max_weekly_hours': max_weekly_hours,
+        'created_at': datetime.now(),
+        'created_by': created_by,
+        'solve_seconds': round(elapsed, 3),
+        'assignments': solver.assignments(),
+        'totals': solver.totals(),
+        'unfilled': len(solver.unfilled()),
+        'version': 0,
+        'changes': [],
+    }
+    document['_id'] = db['app']['schedules'].insert_one(document).inserted_id
+    return document
+
+def repair_schedule(schedule_id, unavailable, changed_by, reason=''):
+    """增量调整保存的排班：按当前的补休记录和新增的请假 unavailable {名字: [date]}，只重排冲突的岗位
+
+    返回改动 [{date, shift, room, before, after}]，排班不存在时返回 None，期间被其他人修改过时抛出 RuntimeError。
+    """
+    document = db['app']['schedules'].find_one({'_id': schedule_id})
+    if document is None:
+        return None
+    begin = time.perf_counter()
+    # 结余沿用生成时的数值，不重新统计
+    solver = scheduler.Scheduler(
+        [item['name'] for item in document['totals']], document['start'], document['days'],
+        {item['name']: item['balance'] for item in document['totals']},
+        schedule_leave(document['start'], document['days']),
+        max_weekly_hours=document['max_weekly_hours'],
+    )
+    solver.restore(document['assignments'])
+    changed = solver.repair(unavailable)
+    metrics.observe('schedule_solve_duration_seconds', time.perf_counter() - begin, mode='repair')
+    diff = [
+        {'date': solver.start + timedelta(days=solver.slots[index][0]), 'shift': solver.slots[index][1], 'room': solver.slots[index][2],
+         'before': before, 'after': after}
+        for index, before, after in changed
+    ]
+    if not diff:
+        return diff
+    # 按 version 判断期间是否有其他修改，避免覆盖
+    result = db['app']['schedules'].update_one(
+        {'_id': schedule_id, 'version': document.get('version', 0)},
+        {
+            '$set': {'assignments': solver.assignments(), 'totals': solver.totals(), 'unfilled': len(solver.unfilled())},
+            '$inc': {'version': 1},
+            '$push': {'changes': {'at': datetime.now(), 'by': changed_by, 'reason': reason, 'diff': diff}},
+        },
+    )
+    if result.matched_count == 0:
+        raise RuntimeError('排班已被其他人修改')
+    return diff
 
 class LoginForm(FlaskForm):
     """登录表单类"""
@@ -58,9 +1557,21 @@ class User(UserMixin):
 
     def verify_password(self, password):
         """密码验证"""
-        if self.password_hash is None:
+        if self.password_hash is None or password is None:
+            return False
+        if is_password_hash(self.password_hash):
+            start = time.perf_counter()
+            result = check_password_hash(self.password_hash, password)
+            metrics.observe('password_hash_duration_seconds', time.perf_counter() - start, operation='check')
+            return result
+        # 旧的明文密码直接比较，验证通过后转换为哈希保存
+        if not hmac.compare_digest(self.password_hash.encode(), password.encode()):
             return False
-        return check_password_hash(self.password_hash, password)
+        if PASSWORD_HASHED:
+            self.password_hash = make_password(password)
+            db['app']['user'].update_one({'_id': ObjectId(self.id)}, {'$set': {'password': self.password_hash}})
+            invalidate_user_cache(self.id)
+        return True
 
     def get_id(self):
         """获取用户ID"""
@@ -77,12 +1588,21 @@ class User(UserMixin):
         """根据用户ID获取用户实体，为 login_user 方法提供支持"""
         if not user_id:
             return None
-        
-        find_user = db['app']['user'].find_one({'_id': ObjectId(user_id)})
+
+        sync_user_caches()
+        now = time.monotonic()
+        with _user_cache_lock:
+            cached = _user_cache.get(user_id)
+        if cached and cached[0] > now:
+            return User(cached[1])
+
+        # 会话只需要用户名和权限，不读取密码
+        find_user = db['app']['user'].find_one({'_id': ObjectId(user_id)}, {'password': 0})
         if find_user:
             find_user['id'] = str(find_user['_id'])
             del find_user['_id']
-            find_user['password'] = generate_password_hash(find_user['password'])
+            with _user_cache_lock:
+                _user_cache[user_id] = (now + USER_CACHE_TTL, find_user)
             return User(find_user)
         return None
 
@@ -100,7 +1620,7 @@ def isNumeric(str):
 
 app = Flask(__name__)  # 创建 Flask 应用
 
-app.secret_key = 'pepperbest'  # 设置表单交互密钥
+app.secret_key = os.environ.get('SECRET_KEY', 'pepperbest')  # 设置表单交互密钥
 
 login_manager = LoginManager()  # 实例化登录管理对象
 login_manager.init_app(app)  # 初始化应用
@@ -110,11 +1630,55 @@ login_manager.login_view = 'login'  # 设置用户登录视图函数 endpoint
 def load_user(user_id):
     return User.get(user_id)
 
+@app.before_request
+def start_timer():
+    g.request_start = time.perf_counter()
+
+@app.after_request
+def record_request_duration(response):
+    if 'request_start' in g:
+        metrics.observe(
+            'http_request_duration_seconds',
+            time.perf_counter() - g.request_start,
+            endpoint=request.endpoint or 'unknown',
+            method=request.method,
+            status=response.status_code,
+        )
+    return response
+
+@before_render_template.connect_via(app)
+def start_render_timer(sender, template, context, **extra):
+    g.render_start = time.perf_counter()
+
+@template_rendered.connect_via(app)
+def record_render_duration(sender, template, context, **extra):
+    if 'render_start' in g:
+        metrics.observe('template_render_duration_seconds', time.perf_counter() - g.pop('render_start'), template=template.name)
+
+def check_ready():
+    """检查数据库是否可用，不可用时抛出异常"""
+    db['app'].command('ping')
+
+def create_app():
+    """生产环境入口：确认数据库可用并创建索引后返回应用，见 wsgi.py"""
+    check_ready()
+    ensure_indexes()
+    return app
+
+@app.route('/healthz')  # 就绪检查
+def healthz():
+    try:
+        check_ready()
+    except pymongo.errors.PyMongoError:
+        return 'unavailable', 503
+    return 'ok'
+
 @app.route('/')  # 首页
 @app.route('/index')  # 首页
 @login_required  # 需要登录才能访问
 def index():
-    return render_template('index.html', username=current_user.username, permission=current_user.permission)
+    summary = get_user_summary(current_user.username)
+    return render_template('index.html', username=current_user.username, permission=current_user.permission, summary=summary)
 
 @app.route('/login', methods=('GET', 'POST'))  # 登录
 def login():
@@ -171,14 +1735,13 @@ def register():
         elif db['app']['user'].count_documents({'name': username}) != 0:
             flash('该名字已存在！')
         else:
-            result = db['app']['user'].insert_one({
+            if insert_record('user', {
                 "name": username,
-                "password": password,
+                "password": make_password(password),
                 'email': email,
                 "permission": 'member',
-            })
-            inserted_id = result.inserted_id
-            if db['app']['user'].count_documents({'_id': ObjectId(inserted_id)}) == 1:
+            }):
+                user_collection_changed()
                 flash('用户创建成功！')
             else:
                 flash('用户创建失败，请重试！')
@@ -219,12 +1782,7 @@ def add_overtime():
                 'room': room,
                 'verify': False,
             }
-            result = db['app']['overtime'].insert_one(dict_to_insert)
-            inserted_id = result.inserted_id
-            if db['app']['overtime'].count_documents({'_id': ObjectId(inserted_id)}) == 1:
-                flash("数据上传成功！")
-            else:
-                flash("数据上传失败，请重试！")
+            flash(insert_interval('overtime', dict_to_insert))
             
     return render_template('add_overtime.html', username=current_user.username)
 
@@ -253,12 +1811,7 @@ def add_compensation():
                 'name': current_user.username,
                 'verify': False,
             }
-            result = db['app']['compensation'].insert_one(dict_to_insert)
-            inserted_id = result.inserted_id
-            if db['app']['compensation'].count_documents({'_id': ObjectId(inserted_id)}) == 1:
-                flash("数据上传成功！")
-            else:
-                flash("数据上传失败，请重试！")
+            flash(insert_interval('compensation', dict_to_insert))
     
     return render_template('add_compensation.html', username=current_user.username)
 
@@ -283,9 +1836,7 @@ def add_writeoff():
                     'hours': float(writeoff_hours),
                     'verify': False,
                 }
-                result = db['app']['writeoff'].insert_one(dict_to_insert)
-                inserted_id = result.inserted_id
-                if db['app']['writeoff'].count_documents({'_id': ObjectId(inserted_id)}) == 1:
+                if insert_record('writeoff', dict_to_insert):
                     flash("数据上传成功！")
                 else:
                     flash("数据上传失败，请重试！")
@@ -296,6 +1847,74 @@ def add_writeoff():
     valid_users = get_valid_users_names()
     return render_template('add_writeoff.html', permission=current_user.permission, users=valid_users)
 
+def view_pipeline(query_type, date1, date2, name, hours1, hours2, sort_order, after=None):
+    """查看页面的聚合管道，按 (hours, _id) 排序，不含分页的 $limit
+
+    after 为上一页最后一条的 (hours, _id)，从它之后继续。
+    """
+    pipline = [{
+        '$match': {
+            'verify': True
+        }
+    }]
+
+    if query_type == 'overtime' or query_type == 'compensation':
+        pipline.append({
+            '$match': {
+                'start_time': {
+                    '$gte': date1,
+                    '$lt': date2
+                }
+            }
+        })
+    else:
+        pipline.append({
+            '$match': {
+                'date': {
+                    '$gte': date1,
+                    '$lt': date2
+                }
+            }
+        })
+
+    if name !='未选择':
+        pipline.append({
+            '$match': {
+                'name': name
+            }
+        })
+
+    pipline.append({
+        '$match': {
+            'hours' : {
+                '$gte': hours1,
+                '$lte': hours2
+            }
+        }
+    })
+
+    if after is not None:
+        op = '$lt' if sort_order == -1 else '$gt'
+        pipline.append({
+            '$match': {
+                '$or': [
+                    {'hours': {op: after[0]}},
+                    {'hours': after[0], '_id': {op: after[1]}},
+                ]
+            }
+        })
+
+    # 查询范围早于归档截止时间时合并归档集合
+    pipline = with_archives(query_type, date1, date2, pipline)
+
+    pipline.append({
+        '$sort': {
+            'hours': sort_order,
+            '_id': sort_order,
+        }
+    })
+    return pipline
+
 @app.route('/view', methods=['GET', 'POST'])  # 查看
 @login_required
 def view():
@@ -314,56 +1933,51 @@ def view():
         date1 = datetime.strptime(date1, '%Y-%m-%d')
         date2 = datetime.strptime(date2, '%Y-%m-%d') + timedelta(days=1)
         
-        pipline = [{
-            '$match': {
-                'verify': True
-            }
-        }]
-        
-        if query_type == 'overtime' or query_type == 'compensation':
-            pipline.append({
-                '$match': {
-                    'start_time': {
-                        '$gte': date1,
-                        '$lt': date2
-                    }
-                }
-            })
-        else:
-            pipline.append({
-                '$match': {
-                    'date': {
-                        '$gte': date1,
-                        '$lt': date2
-                    }
-                }
-            })
-        
-        if name !='未选择':
-            pipline.append({
-                '$match': {
-                    'name': name
-                }
-            })
+        hours1 = times[query_type]['hours1'] == '' and -999999 or int(times[query_type]['hours1'])
+        hours2 = times[query_type]['hours2'] == '' and 999999 or int(times[query_type]['hours2'])
+        # 按 (hours, _id) 翻页，从上一页最后一条之后继续
+        sort_order = int(sort_order)
+        after_hours = data.get('after_hours')
+        after_id = data.get('after_id')
+        after = (float(after_hours), ObjectId(after_id)) if after_hours and after_id else None
+        pipline = view_pipeline(query_type, date1, date2, name, hours1, hours2, sort_order, after)
 
+        # 导出时从游标逐行生成文件，行数较多时放到后台执行
+        export_format = data.get('export')
+        if export_format in ('csv', 'xlsx'):
+            filename = f"{query_type}_{data.get('date1')}_{data.get('date2')}"
+            count = next(aggregate(query_type, pipline + [{'$count': 'count'}]), {'count': 0})['count']
+            if count <= EXPORT_INLINE_LIMIT:
+                aggr = aggregate(query_type, pipline, batchSize=VIEW_STREAM_BATCH_SIZE)
+                return export_response(view_export_rows(query_type, aggr), export_format, filename)
+            def rows_factory():
+                return view_export_rows(query_type, aggregate(query_type, pipline, batchSize=VIEW_STREAM_BATCH_SIZE))
+            job_id = submit_export(rows_factory, export_format, filename, current_user.get_id())
+            return redirect(url_for('export_status', job_id=str(job_id)))
+
+        # 全部显示时边查询边输出，不在内存中保存整个结果
+        if data.get('display_mode') == 'stream':
+            aggr = aggregate(query_type, pipline, batchSize=VIEW_STREAM_BATCH_SIZE)
+            return stream_template('view_result.html', query_type=query_type, query_result=aggr)
+
+        page_size = data.get('page_size', '')
+        page_size = int(page_size) if page_size.isdigit() else VIEW_PAGE_SIZE
+        page_size = min(max(page_size, 1), VIEW_MAX_PAGE_SIZE)
         pipline.append({
-            '$match': {
-                'hours' : {
-                    '$gte': times[query_type]['hours1'] == '' and -999999 or int(times[query_type]['hours1']),
-                    '$lte': times[query_type]['hours2'] == '' and 999999 or int(times[query_type]['hours2'])
-                }
-            }
-        })
-        
-        pipline.append({
-            '$sort': {
-                'hours': int(sort_order)
-            }
+            '$limit': page_size + 1
         })
-        
-        aggr = db['app'][query_type].aggregate(pipline)
+
+        aggr = aggregate(query_type, pipline)
         query_result = [item for item in aggr]
-        return render_template('view_result.html', query_type=query_type, query_result=query_result)
+        next_page = None
+        if len(query_result) > page_size:
+            query_result = query_result[:page_size]
+            next_page = {
+                'after_hours': query_result[-1]['hours'],
+                'after_id': str(query_result[-1]['_id']),
+            }
+        form = {key: value for key, value in data.items() if key not in ('after_hours', 'after_id')}
+        return render_template('view_result.html', query_type=query_type, query_result=query_result, form=form, next_page=next_page)
 
     valid_users = get_valid_users_names()
     return render_template('view.html', username=current_user.username, users=valid_users)
@@ -376,226 +1990,66 @@ def report():
         date1 = data.get('date1')
         date2 = data.get('date2')
         query_type = data.get('query_type')
+        name = data.get('name', '未选择')
 
         date1 = datetime.strptime(date1, '%Y-%m-%d')
         date2 = datetime.strptime(date2, '%Y-%m-%d') + timedelta(days=1)
-                
-        if query_type == '实际加班时间统计':
-            aggr = db['app']['overtime'].aggregate([
-                {
-                    '$match': {
-                        'start_time': {
-                            '$gte': date1,
-                            '$lt': date2
-                        }
-                    }
-                }, {
-                    '$group': {
-                        '_id': '$name',
-                        'hours_count': {'$sum': '$hours'},
-                    }
-                }, {
-                    '$sort': {
-                        'hours_count': -1
-                    }
-                }
-            ])
-            table_title = ['名字', '时长']
-            table_content = [[item['_id'], round(item['hours_count'],1)] for item in aggr]
-            return render_template('report_result.html', query_type=query_type, table_title=table_title, table_content=table_content)
 
-        elif query_type == '调整后加班时间统计':
-            aggr = db['app']['overtime'].aggregate([
-                {
-                    '$match': {
-                        'start_time': {
-                            '$gte': date1,
-                            '$lt': date2
-                        },
-                        'verify': True
-                    }
-                }, {
-                    '$group': {
-                        '_id': '$name',
-                        'hours_count': {'$sum': '$hours'},
-                    }
-                }
-            ])
-            overtime = [[item['_id'], item['hours_count']] for item in aggr]
-            
-            aggr = db['app']['compensation'].aggregate([
-                {
-                    '$match': {
-                        'start_time': {
-                            '$gte': date1,
-                            '$lt': date2
-                        },
-                        'verify': True
-                    }
-                }, {
-                    '$group': {
-                        '_id': '$name',
-                        'hours_count': {'$sum': '$hours'},
-                    }
-                }
-            ])
-            compensation = [[item['_id'], item['hours_count']] for item in aggr]
-            
-            aggr = db['app']['writeoff'].aggregate([
-                {
-                    '$match': {
-                        'date': {
-                            '$gte': date1,
-                            '$lt': date2
-                        },
-                        'verify': True
-                    }
-                }, {
-                    '$group': {
-                        '_id': '$name',
-                        'hours_count': {'$sum': '$hours'},
-                    }
-                }
-            ])
-            writeoff = [[item['_id'], item['hours_count']] for item in aggr]
-                        
-            table_title = ['名字', '时长']
-            table_content = {}
-            
-            for item in overtime:
-                name = item[0]
-                hours = item[1]
-                if item[0] in table_content:
-                    table_content[name] += hours
-                else:
-                    table_content[name] = hours
-            
-            for item in compensation + writeoff:
-                name = item[0]
-                hours = item[1]
-                if item[0] in table_content:
-                    table_content[name] -= hours
-                else:
-                    table_content[name] = -hours
-            
-            table_content = [[key, round(value, 1)] for key, value in table_content.items()]
-            table_content = sorted(table_content, key=lambda x: -x[1])
-            
-            return render_template('report_result.html', query_type=query_type, table_title=table_title, table_content=table_content)
+        cutoff_hour = None
+        if query_type in LATE_SHIFT_REPORTS:
+            cutoff_hour = LATE_SHIFT_REPORTS[query_type] or data.get('cutoff_hour', '')
+            if not str(cutoff_hour).isdigit() or not 0 <= int(cutoff_hour) <= 23:
+                flash('晚班时间输入有误，请输入0~23的整数！')
+                return redirect(url_for('report'))
+            cutoff_hour = int(cutoff_hour)
 
-        elif query_type == '17点以后加班次数统计':
-            aggr = db['app']['overtime'].aggregate([
-                {
-                    '$match': {
-                        'start_time': {
-                            '$gte': date1,
-                            '$lt': date2
-                        },
-                    'verify':True
-                    }
-                }
-            ])
-            table_content = {}
-            for item in aggr:
-                start_time = item['start_time']
-                end_time = item['end_time']
-                name = item['name']
-                # 如果是开始和结束是同一天
-                if start_time.month == end_time.month and start_time.day == end_time.day:
-                    # 如果是17点以后下班
-                    if end_time > datetime(end_time.year, end_time.month, end_time.day, 17, 0):
-                        if name in table_content:
-                            table_content[name] += 1
-                        else:
-                            table_content[name] = 1
-                    # 如果是7点上班
-                    elif start_time < datetime(start_time.year, start_time.month, start_time.day, 8, 0):
-                        if name in table_content:
-                            table_content[name] += 1
-                        else:
-                            table_content[name] = 1
-                # 如果是开始和结束不是同一天 那就肯定是17点以后的了
-                else:
-                    if name in table_content:
-                        table_content[name] += 1
-                    else:
-                        table_content[name] = 1
-            table_content = [[key, value] for key, value in table_content.items()]
-            table_content = sorted(table_content, key=lambda x: -x[1])
-            table_title = ['名字', '次数']
-            
-            return render_template('report_result.html', query_type=query_type, table_title=table_title, table_content=table_content)
-        
-        elif query_type == '22点以后加班次数统计':
-            aggr = db['app']['overtime'].aggregate([
-                {
-                    '$match': {
-                        'start_time': {
-                            '$gte': date1,
-                            '$lt': date2
-                        },
-                    'verify':True
-                    }
-                }
-            ])
-            table_content = {}
-            for item in aggr:
-                start_time = item['start_time']
-                end_time = item['end_time']
-                name = item['name']
-                # 如果是开始和结束是同一天
-                if start_time.month == end_time.month and start_time.day == end_time.day:
-                    # 如果是22点以后下班
-                    if end_time > datetime(end_time.year, end_time.month, end_time.day, 22, 0):
-                        if name in table_content:
-                            table_content[name] += 1
-                        else:
-                            table_content[name] = 1
-                    # 如果是7点上班
-                    elif start_time < datetime(start_time.year, start_time.month, start_time.day, 8, 0):
-                        if name in table_content:
-                            table_content[name] += 1
-                        else:
-                            table_content[name] = 1
-                # 如果是开始和结束不是同一天 那就肯定是22点以后的了
-                else:
-                    if name in table_content:
-                        table_content[name] += 1
-                    else:
-                        table_content[name] = 1
-            table_content = [[key, value] for key, value in table_content.items()]
-            table_content = sorted(table_content, key=lambda x: -x[1])
-            table_title = ['名字', '次数']
-            
+        if query_type in REPORT_TYPES:
+            key = (query_type, date1, date2, name_filter(name).get('name', '未选择'), cutoff_hour)
+            sync_report_cache()
+            result = report_cache.get(key)
+            if result is None:
+                result = build_report(query_type, date1, date2, name, cutoff_hour)
+                report_cache.put(key, date1, date2, result)
+            table_title, table_content = result
+            if data.get('export') in ('csv', 'xlsx'):
+                filename = f"{query_type}_{data.get('date1')}_{data.get('date2')}"
+                return export_response([table_title, *table_content], data.get('export'), filename)
             return render_template('report_result.html', query_type=query_type, table_title=table_title, table_content=table_content)
 
+    valid_users = get_valid_users_names()
+    return render_template('report.html', users=valid_users)
 
-        elif query_type == '核销时间统计':
-            aggr = db['app']['writeoff'].aggregate([
-                {
-                    '$match': {
-                        'date': {
-                            '$gte': date1,
-                            '$lt': date2
-                        },
-                        'verify': True
-                    }
-                }, {
-                    '$group': {
-                        '_id': '$name',
-                        'hours_count': {'$sum': '$hours'},
-                    }
-                }, {
-                    '$sort': {
-                        'hours_count': -1
-                    }
-                }
-            ])
-            table_title = ['名字', '时长']
-            table_content = [[item['_id'], item['hours_count']] for item in aggr]
-            return render_template('report_result.html', query_type=query_type, table_title=table_title, table_content=table_content)
+@app.route('/metrics')  # Prometheus 指标
+def metrics_endpoint():
+    authorized = METRICS_TOKEN and hmac.compare_digest(request.headers.get('Authorization', ''), 'Bearer ' + METRICS_TOKEN)
+    if not authorized and not (current_user.is_authenticated and current_user.permission == 'admin'):
+        return 'forbidden', 403
+    stats = report_cache.stats()
+    gauges = {
+        ('report_cache_entries', ()): stats['size'],
+        ('report_cache_hits_total', ()): stats['hits'],
+        ('report_cache_misses_total', ()): stats['misses'],
+        ('report_cache_invalidations_total', ()): stats['invalidations'],
+    }
+    return Response(metrics.render(gauges), mimetype='text/plain; version=0.0.4')
 
-    return render_template('report.html')
+@app.route('/report_cache')  # 统计结果缓存的命中情况
+@login_required
+def report_cache_stats():
+    if current_user.permission != 'admin':
+        return redirect(url_for('index'))
+    return jsonify(report_cache.stats())
+
+@app.route('/export/<job_id>')  # 后台导出的状态和下载
+@login_required
+def export_status(job_id):
+    job = db['app']['exports'].find_one({'_id': ObjectId(job_id)}) if ObjectId.is_valid(job_id) else None
+    if job is None or (job['owner'] != current_user.get_id() and current_user.permission != 'admin'):
+        flash('导出任务不存在或已过期！')
+        return redirect(url_for('index'))
+    if job['status'] == 'done' and request.args.get('download'):
+        return send_file(job['path'], as_attachment=True, download_name=job['filename'])
+    return render_template('export.html', job=job)
 
 @app.route('/batch_overtime', methods=['GET', 'POST'])  # 批量加班
 @login_required
@@ -618,22 +2072,14 @@ def batch_overtime():
                 flash("时间输入有误！")
             else:
                 hours = (date2 - date1).seconds / 3600
-                number_needs_to_insert = len(chosen_players)
-                number_inserted = 0
-                for player in chosen_players:
-                    # 插入数据的代码
-                    dict_to_insert = {
-                        'start_time': date1,
-                        'end_time': date2,
-                        'hours': hours,
-                        'name': player,
-                        'verify': False,
-                    }
-                    result = db['app']['overtime'].insert_one(dict_to_insert)
-                    inserted_id = result.inserted_id
-                    if db['app']['overtime'].count_documents({'_id': ObjectId(inserted_id)}) == 1:
-                        number_inserted += 1
-                flash(f'一共{number_needs_to_insert}条数据，成功上传{number_inserted}条，请去审核界面查看！')
+                records = [{
+                    'start_time': date1,
+                    'end_time': date2,
+                    'hours': hours,
+                    'name': player,
+                    'verify': False,
+                } for player in chosen_players]
+                flash_batch_result(records, *insert_records('overtime', records))
 
     if current_user.permission != 'admin':
         return redirect(url_for('index'))
@@ -662,22 +2108,14 @@ def batch_compensation():
                 flash("时间输入有误！")
             else:
                 hours = (date2 - date1).seconds / 3600
-                number_needs_to_insert = len(chosen_players)
-                number_inserted = 0
-                for player in chosen_players:
-                    # 插入数据的代码
-                    dict_to_insert = {
-                        'start_time': date1,
-                        'end_time': date2,
-                        'hours': hours,
-                        'name': player,
-                        'verify': False,
-                    }
-                    result = db['app']['compensation'].insert_one(dict_to_insert)
-                    inserted_id = result.inserted_id
-                    if db['app']['compensation'].count_documents({'_id': ObjectId(inserted_id)}) == 1:
-                        number_inserted += 1
-                flash(f'一共{number_needs_to_insert}条数据，成功上传{number_inserted}条，请去审核界面查看！')
+                records = [{
+                    'start_time': date1,
+                    'end_time': date2,
+                    'hours': hours,
+                    'name': player,
+                    'verify': False,
+                } for player in chosen_players]
+                flash_batch_result(records, *insert_records('compensation', records))
 
     if current_user.permission != 'admin':
         return redirect(url_for('index'))
@@ -704,21 +2142,13 @@ def batch_writeoff():
             if not isNumeric(writeoff_hours):
                 flash('输入有误，请重试！')
             else:
-                number_needs_to_insert = len(chosen_players)
-                number_inserted = 0
-                for player in chosen_players:
-                    # 插入数据的代码
-                    dict_to_insert = {
-                        'date': writeoff_date,
-                        'name': player,
-                        'hours': float(writeoff_hours),
-                        'verify': False,
-                    }
-                    result = db['app']['writeoff'].insert_one(dict_to_insert)
-                    inserted_id = result.inserted_id
-                    if db['app']['writeoff'].count_documents({'_id': ObjectId(inserted_id)}) == 1:
-                        number_inserted += 1
-                flash(f'一共{number_needs_to_insert}条数据，成功上传{number_inserted}条，请去审核界面查看！')
+                records = [{
+                    'date': writeoff_date,
+                    'name': player,
+                    'hours': float(writeoff_hours),
+                    'verify': False,
+                } for player in chosen_players]
+                flash_batch_result(records, *insert_records('writeoff', records))
 
     if current_user.permission != 'admin':
         return redirect(url_for('index'))
@@ -733,6 +2163,82 @@ def batch():
         return redirect(url_for('index'))
     return render_template('batch.html', permission=current_user.permission)
 
+@app.route('/import', methods=['GET', 'POST'])  # 从 CSV 或 Excel 文件导入
+@login_required
+def import_file():
+    if current_user.permission != 'admin':
+        return redirect(url_for('index'))
+    if request.method == "POST":
+        collection = request.form.get('collection')
+        upload = request.files.get('file')
+        if collection not in IMPORT_COLLECTIONS or upload is None or not upload.filename.lower().endswith(('.csv', '.xlsx')):
+            flash('请选择类型和 CSV 或 xlsx 文件！')
+        else:
+            job_id = submit_import(upload, collection, current_user.get_id())
+            return redirect(url_for('export_status', job_id=str(job_id)))
+    return render_template('import.html', permission=current_user.permission, collections=IMPORT_COLLECTIONS)
+
+@app.route('/schedule', methods=['GET', 'POST'])  # 排班
+@login_required
+def schedule():
+    if current_user.permission != 'admin':
+        return redirect(url_for('index'))
+    if request.method == "POST":
+        data = request.form
+        days = data.get('days', '')
+        max_weekly_hours = data.get('max_weekly_hours', '')
+        try:
+            start = datetime.strptime(data.get('start', ''), '%Y-%m-%d')
+        except ValueError:
+            flash('开始日期输入有误！')
+            return redirect(url_for('schedule'))
+        if not days.isdigit() or not 1 <= int(days) <= 62 or not max_weekly_hours.isdigit():
+            flash('天数或每周加班上限输入有误！')
+            return redirect(url_for('schedule'))
+        document = generate_schedule(start, int(days), current_user.username, int(max_weekly_hours))
+        return redirect(url_for('schedule_detail', schedule_id=str(document['_id'])))
+    schedules = db['app']['schedules'].find(
+        {}, {'start': 1, 'days': 1, 'created_at': 1, 'created_by': 1, 'unfilled': 1},
+    ).sort('created_at', -1).limit(20)
+    return render_template('schedule.html', schedules=list(schedules), days=SCHEDULE_DAYS, max_weekly_hours=scheduler.MAX_WEEKLY_HOURS)
+
+@app.route('/schedule/<schedule_id>')  # 查看排班结果
+@login_required
+def schedule_detail(schedule_id):
+    document = db['app']['schedules'].find_one({'_id': ObjectId(schedule_id)}) if ObjectId.is_valid(schedule_id) else None
+    if document is None:
+        flash('排班不存在！')
+        return redirect(url_for('index'))
+    users = get_valid_users_names() if current_user.permission == 'admin' else []
+    return render_template('schedule_result.html', schedule=document, permission=current_user.permission, users=users)
+
+@app.route('/schedule/<schedule_id>/repair', methods=['POST'])  # 有人请假时增量调整排班
+@login_required
+def schedule_repair(schedule_id):
+    if current_user.permission != 'admin' or not ObjectId.is_valid(schedule_id):
+        return redirect(url_for('index'))
+    data = request.form
+    name = data.get('name', '未选择')
+    unavailable = {}
+    if name != '未选择':
+        try:
+            date1 = datetime.strptime(data.get('date1'), '%Y-%m-%d')
+            date2 = datetime.strptime(data.get('date2') or data.get('date1'), '%Y-%m-%d')
+        except (TypeError, ValueError):
+            flash('日期输入有误！')
+            return redirect(url_for('schedule_detail', schedule_id=schedule_id))
+        unavailable[name] = [date1 + timedelta(days=day) for day in range((date2 - date1).days + 1)]
+    try:
+        diff = repair_schedule(ObjectId(schedule_id), unavailable, current_user.username, data.get('reason', ''))
+    except RuntimeError as e:
+        flash(f'{e}，请重试！')
+        return redirect(url_for('schedule_detail', schedule_id=schedule_id))
+    if diff is None:
+        flash('排班不存在！')
+        return redirect(url_for('index'))
+    flash(f'调整了{len(diff)}个岗位' if diff else '没有需要调整的岗位')
+    return redirect(url_for('schedule_detail', schedule_id=schedule_id))
+
 @app.route('/verify', methods=['GET', 'POST'])  # 审核
 @login_required
 def verify():
@@ -740,49 +2246,82 @@ def verify():
         if current_user.permission == 'admin':
             data = request.form
             action = data.get('action')
-            _id = data.get('_id')
-            group = data.get('group')
-            
-            if action == 'confirm':
-                db['app'][group].find_one_and_update({'_id': ObjectId(_id)}, {'$set': {'verify': True}})
+
+            if action == 'confirm_filtered':
+                # 确认所有符合当前筛选条件的记录
+                group, name, start, end = parse_verify_filters(request.args)
+                changed = 0
+                for collection in VERIFY_GROUPS:
+                    if group in VERIFY_GROUPS and group != collection:
+                        continue
+                    changed += confirm_records(collection, pending_match(collection, name, start, end))
+                flash(f'已确认{changed}条记录！')
             else:
-                db['app'][group].find_one_and_delete({'_id': ObjectId(_id)})
+                # 单条操作提交 group 和 _id，多选操作提交若干 "group:_id"
+                if data.get('_id'):
+                    selected = [f"{data.get('group')}:{data.get('_id')}"]
+                else:
+                    selected = data.getlist('selected')
+                ids = {}
+                for value in selected:
+                    group, _, _id = value.partition(':')
+                    if group in VERIFY_GROUPS and ObjectId.is_valid(_id):
+                        ids.setdefault(group, []).append(ObjectId(_id))
+
+                changed = 0
+                for group, group_ids in ids.items():
+                    if action in ('confirm', 'bulk_confirm'):
+                        changed += confirm_records(group, {'_id': {'$in': group_ids}})
+                    else:
+                        records = list(db['app'][group].find({'_id': {'$in': group_ids}, 'verify': False}, {VERIFY_GROUPS[group]: 1, 'name': 1}))
+                        invalidate_reports(group, records)
+                        result = db['app'][group].delete_many({'_id': {'$in': [record['_id'] for record in records]}, 'verify': False})
+                        if result.deleted_count == len(records):
+                            update_pending(group, records, -1)
+                        else:
+                            # 其他人同时删除或审核了其中一部分，无法区分时重新统计
+                            rebuild_pending(group)
+                        changed += result.deleted_count
+                if action in ('confirm', 'bulk_confirm'):
+                    flash(f'已确认{changed}条记录！')
+                else:
+                    flash(f'已删除{changed}条记录！')
+            # 处理后回到当前筛选条件和页码，只重新查询这一页
+            return redirect(url_for('verify', **request.args))
         
     if current_user.permission != 'admin':
         return redirect(url_for('index'))
-    
-    overtime_aggr = db['app']['overtime'].aggregate([
-        {
-            '$match': {
-                'verify': False
-            }
-        }
-    ])
-    compensation_aggr = db['app']['compensation'].aggregate([
-        {
-            '$match': {
-                'verify': False
-            }
-        }
-    ])
-    writeoff_aggr = db['app']['writeoff'].aggregate([
-        {
-            '$match': {
-                'verify': False
-            }
-        }
-    ])
-    
-    overtime = [item for item in overtime_aggr]
-    compensation = [item for item in compensation_aggr]
-    writeoff = [item for item in writeoff_aggr]
-    
+
+    args = request.args
+    group, name, start, end = parse_verify_filters(args)
+    date1 = args.get('date1', '')
+    date2 = args.get('date2', '')
+    page = args.get('page', '')
+    page = int(page) if page.isdigit() and int(page) > 0 else 1
+
+    # 三类记录的查询相互独立，并发执行
+    collections = [collection for collection in VERIFY_GROUPS if group not in VERIFY_GROUPS or group == collection]
+    results = run_queries([(collection, pending_pipeline(collection, name, start, end, page)) for collection in collections])
+    pending = {collection: [] for collection in VERIFY_GROUPS}
+    has_next = False
+    for collection, items in zip(collections, results):
+        if len(items) > VERIFY_PAGE_SIZE:
+            has_next = True
+            items = items[:VERIFY_PAGE_SIZE]
+        pending[collection] = items
+
+    page_args = {key: value for key, value in args.items() if key != 'page'}
     return render_template(
         'verify.html',
         permission=current_user.permission,
-        overtime=overtime,
-        compensation=compensation,
-        writeoff=writeoff
+        overtime=pending['overtime'],
+        compensation=pending['compensation'],
+        writeoff=pending['writeoff'],
+        users=get_valid_users_names(),
+        filters={'group': group, 'name': name, 'date1': date1, 'date2': date2},
+        page=page,
+        prev_url=url_for('verify', page=page - 1, **page_args) if page > 1 else None,
+        next_url=url_for('verify', page=page + 1, **page_args) if has_next else None,
     )
 
 @app.route('/user_manage')
@@ -815,14 +2354,14 @@ def user_add():
             elif db['app']['user'].count_documents({'name': username}) != 0:
                 flash('该名字已存在！')
             else:
-                result = db['app']['user'].insert_one({
+                inserted = insert_record('user', {
                     "name": username,
-                    "password": password,
+                    "password": make_password(password),
                     'email': email,
                     "permission": 'member',
                 })
-                inserted_id = result.inserted_id
-                if db['app']['user'].count_documents({'_id': ObjectId(inserted_id)}) == 1:
+                user_collection_changed()
+                if inserted:
                     flash('用户创建成功！')
                 else:
                     flash('用户创建失败，请重试！')
@@ -840,6 +2379,7 @@ def user_remove():
             data = request.form
             _id = data.get('_id')
             db['app']['user'].find_one_and_delete({'_id': ObjectId(_id)})
+            user_collection_changed(_id)
 
     if current_user.permission != 'admin':
         return redirect(url_for('index'))
@@ -852,5 +2392,91 @@ def user_remove():
         })
     return render_template("user_remove.html", permission=current_user.permission, table_content=table_content)
 
+@app.cli.command('init-indexes')  # flask --app app init-indexes
+def init_indexes_command():
+    """创建数据库索引"""
+    for name in ensure_indexes():
+        print(name)
+
+@app.cli.command('check-indexes')  # flask --app app check-indexes
+def check_indexes_command():
+    """检查查看和统计页面的聚合是否使用了索引
+
+    用页面实际构造的管道检查：范围跨过月初，覆盖月度汇总的零散部分；早于归档截止时间时包括归档集合。
+    """
+    date2 = datetime.now()
+    date1 = date2 - timedelta(days=400)
+    names = [None, *get_valid_users_names()[:1]]
+    pipelines = []
+    for name in names:
+        for query_type in REPORT_TYPES:
+            cutoff_hour = LATE_SHIFT_REPORTS.get(query_type) or shifts.LATE_HOUR
+            pipelines.append((query_type, name, *report_pipeline(query_type, date1, date2, name, cutoff_hour)))
+        for query_type in VERIFY_GROUPS:
+            pipeline = view_pipeline(query_type, date1, date2, name or '未选择', -999999, 999999, -1)
+            pipelines.append(('查看', name, query_type, pipeline + [{'$limit': VIEW_PAGE_SIZE + 1}]))
+    for label, name, collection, pipeline in pipelines:
+        print(label, collection, name or '', 'OK' if explain_pipeline(collection, pipeline) else 'COLLSCAN')
+
+@app.cli.command('archive-records')  # flask --app app archive-records
+@click.option('--days', default=ARCHIVE_AFTER_DAYS, show_default=True, help='保留在原集合中的天数')
+def archive_records_command(days):
+    """把较早的已审核记录移到按年份分开的归档集合"""
+    cutoff = month_start(datetime.now() - timedelta(days=days))
+    for collection, count in archive_records(cutoff).items():
+        print(collection, count)
+
+@app.cli.command('generate-schedule')  # flask --app app generate-schedule --start 2026-11-01
+@click.option('--start', required=True, type=click.DateTime(formats=['%Y-%m-%d']), help='排班开始日期')
+@click.option('--days', default=SCHEDULE_DAYS, show_default=True)
+@click.option('--max-weekly-hours', default=scheduler.MAX_WEEKLY_HOURS, show_default=True)
+def generate_schedule_command(start, days, max_weekly_hours):
+    """生成排班并保存"""
+    document = generate_schedule(start, days, 'cli', max_weekly_hours)
+    print(document['_id'], f"{len(document['assignments'])}个岗位", f"{document['unfilled']}个未排", f"{document['solve_seconds']}s")
+
+@app.cli.command('repair-schedule')  # flask --app app repair-schedule <排班id> --name 张三 --date 2026-11-03
+@click.argument('schedule_id')
+@click.option('--name', help='请假的人，不填时只按补休记录调整')
+@click.option('--date', 'dates', multiple=True, type=click.DateTime(formats=['%Y-%m-%d']), help='请假的日期，可重复')
+def repair_schedule_command(schedule_id, name, dates):
+    """有人请假或新增补休时增量调整排班，输出改动的岗位"""
+    diff = repair_schedule(ObjectId(schedule_id), {name: list(dates)} if name else {}, 'cli', '命令行调整')
+    if diff is None:
+        raise click.ClickException('排班不存在')
+    for item in diff:
+        print(item['date'].strftime('%Y-%m-%d'), item['shift'], item['room'], item['before'], '->', item['after'])
+
+@app.cli.command('import-records')  # flask --app app import-records 加班.xlsx --type overtime --report 错误.csv
+@click.argument('path', type=click.Path(exists=True, dir_okay=False))
+@click.option('--type', 'collection', required=True, type=click.Choice(list(IMPORT_COLLECTIONS)))
+@click.option('--report', 'report_path', help='失败的行写入这个 CSV 文件，不填时输出到屏幕')
+def import_records_command(path, collection, report_path):
+    """从 CSV 或 xlsx 文件导入历史记录，导入的记录需要审核"""
+    file_format = 'xlsx' if path.lower().endswith('.xlsx') else 'csv'
+    started = time.perf_counter()
+    file = open(report_path, 'w', encoding='utf-8-sig', newline='') if report_path else None
+    try:
+        if file is not None:
+            writer = csv.writer(file)
+            writer.writerow(['行号', '名字', '原因'])
+            report = lambda *row: writer.writerow(row)
+        else:
+            report = print
+        total, inserted = import_records(collection, read_import_rows(path, file_format), report)
+    except ValueError as e:
+        raise click.ClickException(str(e))
+    finally:
+        if file is not None:
+            file.close()
+    print(f'一共{total}行，成功导入{inserted}条，失败{total - inserted}条，耗时{time.perf_counter() - started:.1f}s')
+
+@app.cli.command('rebuild-balances')  # flask --app app rebuild-balances
+def rebuild_balances_command():
+    """重建 balances 月度汇总表"""
+    rebuild_balances()
+    print(db['app']['balances'].count_documents({}))
+
 if __name__ == '__main__':
-    app.run(debug=True, threaded=True, host='0.0.0.0', port=80)
+    # 开发调试用，生产环境请用 gunicorn 启动，见 gunicorn.conf.py
+    create_app().run(debug=os.environ.get('FLASK_DEBUG') == '1', threaded=True, host='0.0.0.0', port=80)
@@ -0,0 +1,323 @@
+#!/bin/python3
+"""增量备份：定期做一次基础快照，之后用 change stream 把每一次修改追加到压缩的分段文件里，可以恢复到任意时间点
+
+change stream 需要副本集，单机部署时用 docker.sh 中的 --replSet 启动并执行一次 rs.initiate。
+
+做基础快照（例如每周一次），同时记下 change stream 的起点：
+    python backup.py snapshot
+
+持续记录修改（常驻运行，中断后重新启动会从上次记录的位置继续，有新的基础快照时自动改为写入新快照）：
+    python backup.py tail
+
+第一次 snapshot 之后，之后的每次 snapshot 都必须在 tail 运行期间做：恢复时只重放不晚于目标时间的最新快照的分段，
+如果上一个快照到新快照之间 tail 没有运行，这段时间的修改无法恢复。
+
+恢复到某个时间点（默认恢复到最后一条记录），目标库中的同名集合会被覆盖：
+    python backup.py restore --uri mongodb://localhost:27018/ --at "2026-10-01 12:00"
+
+在本地测试用 mongod 上恢复并与当前数据库逐个集合比对：
+    python backup.py verify --uri mongodb://localhost:27018/
+
+只保留最近几次基础快照：
+    python backup.py prune --keep 4
+
+每个基础快照是 BACKUP_DIR 下的一个目录，其中 manifest.json 记录快照时间和 change stream 起点，
+<集合>.bson.gz 是快照数据，segments/ 下是之后的修改，每个分段是追加写入的 gzip 压缩 BSON。
+"""
+
+import argparse
+import gzip
+import hashlib
+import os
+import shutil
+import time
+from datetime import datetime
+
+import bson
+from bson.json_util import dumps, loads
+from pymongo import MongoClient
+
+MONGO_URI = os.environ.get('MONGO_URI', 'mongodb://localhost:27017/')
+DATABASE = 'app'
+BACKUP_DIR = os.environ.get('BACKUP_DIR', '/mongo/backup')
+
+# 单个分段最多记录的修改条数和时长，超过后换一个新文件
+SEGMENT_MAX_EVENTS = 10000
+SEGMENT_MAX_SECONDS = 3600
+# 每累积多少条修改或多少秒写入一次磁盘
+FLUSH_EVENTS = 100
+FLUSH_SECONDS = 5
+# tail 检查是否有新的基础快照的间隔（秒）
+BASE_CHECK_SECONDS = 30
+# 恢复时每批写入的文档数
+RESTORE_BATCH_SIZE = 1000
+
+
+def list_bases(backup_dir):
+    """按时间从早到晚列出基础快照目录，只包括已经完成的"""
+    if not os.path.isdir(backup_dir):
+        return []
+    return sorted(
+        os.path.join(backup_dir, name) for name in os.listdir(backup_dir)
+        if os.path.exists(os.path.join(backup_dir, name, 'manifest.json'))
+    )
+
+
+def read_manifest(base):
+    with open(os.path.join(base, 'manifest.json'), encoding='utf-8') as file:
+        return loads(file.read())
+
+
+def list_segments(base):
+    directory = os.path.join(base, 'segments')
+    if not os.path.isdir(directory):
+        return []
+    return sorted(os.path.join(directory, name) for name in os.listdir(directory) if name.endswith('.bson.gz'))
+
+
+def read_events(path):
+    """逐条读出分段中的修改，末尾因中断而不完整的记录直接忽略"""
+    with gzip.open(path, 'rb') as file:
+        try:
+            for event in bson.decode_file_iter(file):
+                yield event
+        except (EOFError, OSError, bson.errors.InvalidBSON):
+            return
+
+
+def snapshot(client, backup_dir):
+    """先记下 change stream 的当前位置再导出各集合，导出期间的修改会在恢复时重放，重放是幂等的"""
+    source = client[DATABASE]
+    with source.watch() as stream:
+        stream.try_next()
+        resume_token = stream.resume_token
+    taken_at = datetime.now()
+    base = os.path.join(backup_dir, taken_at.strftime('%Y%m%d%H%M%S'))
+    partial = base + '.partial'
+    os.makedirs(os.path.join(partial, 'segments'))
+    counts = {}
+    for name in source.list_collection_names():
+        count = 0
+        with gzip.open(os.path.join(partial, name + '.bson.gz'), 'wb') as file:
+            for document in source[name].find().sort('_id', 1):
+                file.write(bson.encode(document))
+                count += 1
+        counts[name] = count
+    with open(os.path.join(partial, 'manifest.json'), 'w', encoding='utf-8') as file:
+        file.write(dumps({'taken_at': taken_at, 'resume_token': resume_token, 'collections': counts}, indent=2))
+    os.rename(partial, base)
+    return base, counts
+
+
+def resume_point(base):
+    """base 中最后一条已记录修改的 change stream 位置，还没有修改时为快照的起点"""
+    resume_token = read_manifest(base)['resume_token']
+    segments = list_segments(base)
+    if segments:
+        for event in read_events(segments[-1]):
+            resume_token = event['token']
+    return resume_token
+
+
+def tail(client, backup_dir):
+    """把最新基础快照之后的修改追加到分段文件，直到被中断
+
+    运行期间做了新的基础快照时，改为从新快照的起点继续写入新快照的目录，
+    新快照起点之后、切换之前的修改在两个目录中都有，重放是幂等的。
+    """
+    bases = list_bases(backup_dir)
+    if not bases:
+        raise SystemExit('没有基础快照，请先运行 snapshot')
+    base = bases[-1]
+    while base is not None:
+        base = tail_base(client, backup_dir, base)
+
+
+def tail_base(client, backup_dir, base):
+    """把修改追加到 base 的分段文件，发现更新的基础快照时返回它"""
+    resume_token = resume_point(base)
+    file = None
+    try:
+        with client[DATABASE].watch(resume_after=resume_token) as stream:
+            pending = 0
+            last_flush = time.monotonic()
+            last_check = last_flush
+            opened = 0
+            events = 0
+            while stream.alive:
+                change = stream.try_next()
+                now = time.monotonic()
+                if change is not None:
+                    if file is None or events >= SEGMENT_MAX_EVENTS or now - opened >= SEGMENT_MAX_SECONDS:
+                        if file is not None:
+                            file.close()
+                        # 用第一条修改的时间命名分段，恢复时按文件名顺序重放
+                        name = '%010d-%05d.bson.gz' % (change['clusterTime'].time, change['clusterTime'].inc)
+                        file = gzip.open(os.path.join(base, 'segments', name), 'ab')
+                        opened = now
+                        events = 0
+                    event = {
+                        'token': change['_id'],
+                        'time': change['clusterTime'],
+                        'op': change['operationType'],
+                        'collection': change.get('ns', {}).get('coll'),
+                        'key': change.get('documentKey'),
+                    }
+                    if change['operationType'] in ('insert', 'replace'):
+                        event['document'] = change['fullDocument']
+                    elif change['operationType'] == 'update':
+                        description = change['updateDescription']
+                        event['set'] = description.get('updatedFields', {})
+                        event['unset'] = description.get('removedFields', [])
+                    file.write(bson.encode(event))
+                    pending += 1
+                    events += 1
+                elif file is None or not pending:
+                    time.sleep(0.5)
+                if file is not None and pending and (pending >= FLUSH_EVENTS or now - last_flush >= FLUSH_SECONDS):
+                    file.flush()
+                    os.fsync(file.fileno())
+                    pending = 0
+                    last_flush = now
+                if now - last_check >= BASE_CHECK_SECONDS:
+                    last_check = now
+                    newest = list_bases(backup_dir)[-1]
+                    if newest != base:
+                        return newest
+    finally:
+        if file is not None:
+            file.flush()
+            os.fsync(file.fileno())
+            file.close()
+    return None
+
+
+def apply_events(target, events):
+    """重放一批修改，插入和替换用 upsert，更新和删除按 _id，重复重放结果不变"""
+    for event in events:
+        collection = target[event['collection']] if event.get('collection') else None
+        op = event['op']
+        if op in ('insert', 'replace'):
+            collection.replace_one({'_id': event['key']['_id']}, event['document'], upsert=True)
+        elif op == 'update':
+            update = {}
+            if event['set']:
+                update['$set'] = event['set']
+            if event['unset']:
+                update['$unset'] = {field: '' for field in event['unset']}
+            if update:
+                collection.update_one({'_id': event['key']['_id']}, update)
+        elif op == 'delete':
+            collection.delete_one({'_id': event['key']['_id']})
+        elif op == 'drop':
+            collection.drop()
+        elif op == 'rename':
+            # 改名很少出现，需要手工处理
+            print('跳过集合改名', event['collection'])
+
+
+def restore(backup_dir, target, at=None):
+    """在 target 数据库上恢复到 at 时刻的状态，at 为空时恢复到最后一条修改"""
+    bases = list_bases(backup_dir)
+    if at is not None:
+        bases = [base for base in bases if read_manifest(base)['taken_at'] <= at]
+    if not bases:
+        raise SystemExit('没有早于指定时间的基础快照')
+    base = bases[-1]
+    manifest = read_manifest(base)
+    for name in manifest['collections']:
+        target[name].drop()
+        with gzip.open(os.path.join(base, name + '.bson.gz'), 'rb') as file:
+            batch = []
+            for document in bson.decode_file_iter(file):
+                batch.append(document)
+                if len(batch) == RESTORE_BATCH_SIZE:
+                    target[name].insert_many(batch)
+                    batch = []
+            if batch:
+                target[name].insert_many(batch)
+
+    replayed = 0
+    last = manifest['taken_at']
+    for path in list_segments(base):
+        for event in read_events(path):
+            event_time = datetime.fromtimestamp(event['time'].time)
+            if at is not None and event_time > at:
+                return base, replayed, last
+            apply_events(target, [event])
+            replayed += 1
+            last = event_time
+    return base, replayed, last
+
+
+def digest(collection):
+    """集合按 _id 排序后的文档数和 SHA-256"""
+    sha = hashlib.sha256()
+    count = 0
+    for document in collection.find().sort('_id', 1):
+        sha.update(bson.encode(document))
+        count += 1
+    return count, sha.hexdigest()
+
+
+def verify(backup_dir, source, target):
+    """恢复到最新状态后与当前数据库逐个集合比对，tail 未停止时可能因为新的修改而不一致"""
+    base, replayed, last = restore(backup_dir, target)
+    print(f'从 {base} 恢复，重放 {replayed} 条修改，截至 {last}')
+    names = sorted(set(source.list_collection_names()) | set(target.list_collection_names()))
+    ok = True
+    for name in names:
+        expected, actual = digest(source[name]), digest(target[name])
+        match = expected == actual
+        ok = ok and match
+        print(f"{name:20s} {expected[0]:>10d} {actual[0]:>10d} {'OK' if match else '不一致'}")
+    return ok
+
+
+def prune(backup_dir, keep):
+    bases = list_bases(backup_dir)
+    for base in bases[:-keep] if keep > 0 else []:
+        shutil.rmtree(base)
+        print('已删除', base)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='内镜中心管理系统增量备份')
+    parser.add_argument('--source', default=MONGO_URI, help='被备份的数据库地址，默认为 MONGO_URI')
+    parser.add_argument('--dir', default=BACKUP_DIR, help='备份目录，默认为 BACKUP_DIR')
+    commands = parser.add_subparsers(dest='command', required=True)
+    commands.add_parser('snapshot', help='做一次基础快照')
+    commands.add_parser('tail', help='持续记录修改')
+    restore_parser = commands.add_parser('restore', help='恢复到某个时间点')
+    restore_parser.add_argument('--uri', required=True, help='恢复到的数据库地址')
+    restore_parser.add_argument('--db', default=DATABASE, help='恢复到的数据库名')
+    restore_parser.add_argument('--at', type=datetime.fromisoformat, help='恢复到的时间，如 "2026-10-01 12:00"')
+    verify_parser = commands.add_parser('verify', help='在测试用 mongod 上恢复并与当前数据库比对')
+    verify_parser.add_argument('--uri', required=True, help='测试用 mongod 的地址，不能是被备份的数据库')
+    verify_parser.add_argument('--db', default='app_restore_check', help='测试用的数据库名，会被覆盖')
+    prune_parser = commands.add_parser('prune', help='删除旧的基础快照及其修改记录')
+    prune_parser.add_argument('--keep', type=int, default=4)
+    args = parser.parse_args()
+
+    if args.command == 'snapshot':
+        base, counts = snapshot(MongoClient(args.source), args.dir)
+        print(base, counts)
+    elif args.command == 'tail':
+        try:
+            tail(MongoClient(args.source), args.dir)
+        except KeyboardInterrupt:
+            pass
+    elif args.command == 'restore':
+        base, replayed, last = restore(args.dir, MongoClient(args.uri)[args.db], args.at)
+        print(f'从 {base} 恢复，重放 {replayed} 条修改，截至 {last}')
+    elif args.command == 'verify':
+        if args.uri == args.source and args.db == DATABASE:
+            parser.error('不能在被备份的数据库上验证')
+        if not verify(args.dir, MongoClient(args.source)[DATABASE], MongoClient(args.uri)[args.db]):
+            raise SystemExit(1)
+    elif args.command == 'prune':
+        prune(args.dir, args.keep)
+
+
+if __name__ == '__main__':
+    main()
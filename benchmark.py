@@ -0,0 +1,347 @@
+#!/bin/python3
+"""性能测试：生成模拟数据，逐个请求各页面，统计 p50/p95/p99 延迟和吞吐量并保存为 JSON
+
+用 mongomock 在内存中测试（需要 pip install mongomock）：
+    python benchmark.py --mongomock --staff 50 --years 1
+
+用本地 mongod 测试，数据写入该实例的 app 数据库，只能对空库或专门的测试库使用：
+    python benchmark.py --mongo-uri mongodb://localhost:27018/ --staff 200 --years 5
+
+对已经启动的服务并发请求（数据需事先准备好）：
+    python benchmark.py --url http://localhost:8000 --concurrency 8 --username admin --password ...
+
+排班求解耗时与人数的关系，不需要数据库：
+    python benchmark.py --schedule --schedule-sizes 50,100,200,400 --days 30 --iterations 3
+
+与上一次的结果对比：
+    python benchmark.py --mongomock --compare bench_results/上一次.json
+"""
+
+import argparse
+import http.cookiejar
+import json
+import math
+import os
+import random
+import subprocess
+import threading
+import time
+import urllib.parse
+import urllib.request
+from datetime import datetime, timedelta
+
+ADMIN_NAME = 'bench_admin'
+ADMIN_PASSWORD = 'bench_password'
+
+
+def percentile(values, p):
+    """最近秩法计算百分位数"""
+    values = sorted(values)
+    if not values:
+        return 0.0
+    return values[max(0, math.ceil(p / 100 * len(values)) - 1)]
+
+
+def summarize(durations, wall_time):
+    """延迟单位为毫秒，吞吐量为每秒请求数"""
+    return {
+        'count': len(durations),
+        'mean_ms': round(sum(durations) / len(durations) * 1000, 3) if durations else 0.0,
+        'p50_ms': round(percentile(durations, 50) * 1000, 3),
+        'p95_ms': round(percentile(durations, 95) * 1000, 3),
+        'p99_ms': round(percentile(durations, 99) * 1000, 3),
+        'throughput_rps': round(len(durations) / wall_time, 2) if wall_time else 0.0,
+    }
+
+
+def seed(db, staff, years, shifts_per_week, end):
+    """生成 staff 个人 years 年的加班、补休和核销记录，大部分已审核"""
+    random.seed(0)
+    names = [f'员工{i:03d}' for i in range(staff)]
+    db['app']['user'].insert_many([
+        {'name': name, 'password': 'x', 'email': f'{i}@qq.com', 'permission': 'member'}
+        for i, name in enumerate(names)
+    ])
+    start = end - timedelta(days=365 * years)
+    days = (end - start).days
+    per_person = int(days / 7 * shifts_per_week)
+
+    def chunks(make, count):
+        batch = []
+        for _ in range(count):
+            batch.append(make())
+            if len(batch) == 5000:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
+
+    def shift(name):
+        start_time = start + timedelta(days=random.randrange(days), minutes=random.randrange(6 * 60, 20 * 60, 30))
+        hours = random.choice([1, 1.5, 2, 3, 4, 6, 8])
+        return {
+            'start_time': start_time,
+            'end_time': start_time + timedelta(hours=hours),
+            'hours': float(hours),
+            'name': name,
+            'shift': random.choice(['早班', '晚班', '夜班']),
+            'room': str(random.randint(1, 8)),
+            'verify': random.random() < 0.97,
+        }
+
+    def writeoff(name):
+        return {
+            'date': start + timedelta(days=random.randrange(days)),
+            'name': name,
+            'hours': float(random.choice([2, 4, 8])),
+            'verify': random.random() < 0.97,
+        }
+
+    counts = {}
+    for collection, make, count in [
+        ('overtime', lambda: shift(random.choice(names)), per_person * staff),
+        ('compensation', lambda: shift(random.choice(names)), per_person * staff // 4),
+        ('writeoff', lambda: writeoff(random.choice(names)), staff * years * 4),
+    ]:
+        for batch in chunks(make, count):
+            db['app'][collection].insert_many(batch)
+        counts[collection] = count
+    return names, counts
+
+
+def bench_test_client(app, names, iterations, end, report_cache):
+    """通过 Flask test client 在本进程内请求各个页面"""
+    client = app.app.test_client()
+    client.post('/login', data={'action': 'login', 'username': ADMIN_NAME, 'password': ADMIN_PASSWORD})
+    if not report_cache:
+        app.report_cache = app.ReportCache(0, 0)
+
+    date1 = (end - timedelta(days=365)).strftime('%Y-%m-%d')
+    date2 = end.strftime('%Y-%m-%d')
+    view_form = {
+        'date1': date1, 'date2': date2, 'query_type': 'overtime', 'name': '未选择',
+        'real_overtime_hours1': '', 'real_overtime_hours2': '', 'sort_order': '-1',
+        'display_mode': 'page', 'page_size': '50',
+    }
+    batch_form = {'date1': (end - timedelta(hours=3)).strftime('%Y-%m-%dT%H:%M'), 'date2': end.strftime('%Y-%m-%dT%H:%M')}
+    batch_form.update({name: name for name in names[:60]})
+
+    routes = {'GET /index': lambda: client.get('/index'), 'GET /verify': lambda: client.get('/verify')}
+    for query_type in app.REPORT_TYPES:
+        form = {'date1': date1, 'date2': date2, 'query_type': query_type, 'cutoff_hour': '20'}
+        routes[f'POST /report {query_type}'] = lambda form=form: client.post('/report', data=form)
+    routes['POST /view'] = lambda: client.post('/view', data=view_form)
+    routes['POST /batch_overtime (60人)'] = lambda: client.post('/batch_overtime', data=batch_form)
+
+    results = {}
+    for route, call in routes.items():
+        durations = []
+        started = time.perf_counter()
+        for _ in range(iterations):
+            t = time.perf_counter()
+            response = call()
+            response.get_data()
+            durations.append(time.perf_counter() - t)
+            if response.status_code >= 400:
+                break
+        if response.status_code >= 400:
+            # mongomock 不支持 $unionWith 等操作，这类页面只能在真实的 mongod 上测试
+            results[route] = {'error': f'HTTP {response.status_code}'}
+            print(f'{route:40s} 失败：HTTP {response.status_code}')
+            continue
+        results[route] = summarize(durations, time.perf_counter() - started)
+        print(f"{route:40s} p50 {results[route]['p50_ms']:9.2f}ms  p95 {results[route]['p95_ms']:9.2f}ms  p99 {results[route]['p99_ms']:9.2f}ms")
+
+    # 时间冲突检查直接调用，用不同的 --years 运行并 --compare，可以看出历史记录增多时耗时是否变化
+    start_time = end - timedelta(hours=3)
+    checks = {
+        'find_conflicts 1条': [{'name': names[0], 'start_time': start_time, 'end_time': end}],
+        'find_conflicts 60人': [{'name': name, 'start_time': start_time, 'end_time': end} for name in names[:60]],
+    }
+    for route, records in checks.items():
+        durations = []
+        started = time.perf_counter()
+        for _ in range(iterations):
+            t = time.perf_counter()
+            app.find_conflicts(records)
+            durations.append(time.perf_counter() - t)
+        results[route] = summarize(durations, time.perf_counter() - started)
+        print(f"{route:40s} p50 {results[route]['p50_ms']:9.2f}ms  p95 {results[route]['p95_ms']:9.2f}ms  p99 {results[route]['p99_ms']:9.2f}ms")
+    return results
+
+
+def bench_http(url, username, password, iterations, concurrency, end):
+    """用多个线程并发请求已经启动的服务，每个线程各自登录"""
+    date1 = (end - timedelta(days=365)).strftime('%Y-%m-%d')
+    date2 = end.strftime('%Y-%m-%d')
+    routes = {
+        'GET /index': ('/index', None),
+        'GET /verify': ('/verify', None),
+        'POST /report 调整后加班时间统计': ('/report', {'date1': date1, 'date2': date2, 'query_type': '调整后加班时间统计'}),
+        'POST /report 实际加班时间统计': ('/report', {'date1': date1, 'date2': date2, 'query_type': '实际加班时间统计'}),
+        'POST /view': ('/view', {
+            'date1': date1, 'date2': date2, 'query_type': 'overtime', 'name': '未选择',
+            'real_overtime_hours1': '', 'real_overtime_hours2': '', 'sort_order': '-1',
+        }),
+    }
+
+    def opener():
+        jar = http.cookiejar.CookieJar()
+        o = urllib.request.build_opener(urllib.request.HTTPCookieProcessor(jar))
+        o.open(url + '/login', urllib.parse.urlencode({'action': 'login', 'username': username, 'password': password}).encode())
+        return o
+
+    results = {}
+    for route, (path, form) in routes.items():
+        durations = []
+        lock = threading.Lock()
+
+        def worker():
+            o = opener()
+            data = urllib.parse.urlencode(form).encode() if form else None
+            local = []
+            for _ in range(iterations):
+                t = time.perf_counter()
+                with o.open(url + path, data) as response:
+                    response.read()
+                local.append(time.perf_counter() - t)
+            with lock:
+                durations.extend(local)
+
+        threads = [threading.Thread(target=worker) for _ in range(concurrency)]
+        started = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        results[route] = summarize(durations, time.perf_counter() - started)
+        print(f"{route:40s} p50 {results[route]['p50_ms']:9.2f}ms  p95 {results[route]['p95_ms']:9.2f}ms  {results[route]['throughput_rps']:8.1f} req/s")
+    return results
+
+
+def bench_schedule(sizes, days, iterations, shifts_per_week):
+    """随机生成结余、补休和每天的岗位，测量不同人数下的排班求解耗时"""
+    import scheduler
+
+    results = {}
+    start = datetime(2026, 1, 5)
+    for staff in sizes:
+        random.seed(staff)
+        names = [f'员工{i:03d}' for i in range(staff)]
+        balances = {name: random.uniform(-40, 60) for name in names}
+        leave = {name: [start + timedelta(days=random.randrange(days))] for name in random.sample(names, staff // 5)}
+        # 每天的岗位数与每人每周的加班次数相当，早班、晚班、夜班约为 1:2.4:0.6
+        per_day = max(3, round(staff * shifts_per_week / 7))
+        demand = {
+            '早班': [str(i) for i in range(1, per_day // 4 + 1)],
+            '晚班': [str(i) for i in range(1, per_day * 3 // 5 + 1)],
+            '夜班': [str(i) for i in range(1, max(1, per_day * 3 // 20) + 1)],
+        }
+        durations = []
+        started = time.perf_counter()
+        for _ in range(iterations):
+            solver = scheduler.Scheduler(names, start, days, balances, leave, demand)
+            t = time.perf_counter()
+            rounds = solver.solve()
+            durations.append(time.perf_counter() - t)
+        route = f'schedule {staff}人×{days}天'
+        results[route] = summarize(durations, time.perf_counter() - started)
+        results[route].update({
+            'slots': len(solver.slots),
+            'rounds': rounds,
+            'unfilled': len(solver.unfilled()),
+            'spread_before': round(max(balances.values()) - min(balances.values()), 1),
+            'spread_after': round(solver.spread(), 1),
+        })
+        r = results[route]
+        print(f"{route:40s} p50 {r['p50_ms']:9.2f}ms  {r['slots']}个岗位 未排{r['unfilled']} 结余差 {r['spread_before']} -> {r['spread_after']}")
+    return results
+
+
+def compare(old_path, results):
+    """打印与上一次结果相比 p50/p95 的变化"""
+    with open(old_path, encoding='utf-8') as file:
+        old = json.load(file)['routes']
+    for route, new in results.items():
+        if route in old and 'error' not in new and 'error' not in old[route]:
+            for key in ('p50_ms', 'p95_ms'):
+                before, after = old[route][key], new[key]
+                change = (after - before) / before * 100 if before else 0.0
+                print(f'{route:40s} {key} {before:9.2f} -> {after:9.2f} ({change:+.1f}%)')
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description='内镜中心管理系统性能测试')
+    target = parser.add_mutually_exclusive_group(required=True)
+    target.add_argument('--mongomock', action='store_true', help='使用内存中的 mongomock')
+    target.add_argument('--mongo-uri', help='本地测试用 mongod 的地址，数据写入其 app 数据库')
+    target.add_argument('--url', help='已经启动的服务地址，用并发 HTTP 请求测试')
+    target.add_argument('--schedule', action='store_true', help='只测排班求解耗时')
+    parser.add_argument('--staff', type=int, default=200, help='模拟的员工人数')
+    parser.add_argument('--years', type=int, default=5, help='模拟的年数')
+    parser.add_argument('--shifts-per-week', type=float, default=3, help='每人每周的加班次数')
+    parser.add_argument('--schedule-sizes', default='50,100,200,400', help='--schedule 模式下的人数，逗号分隔')
+    parser.add_argument('--days', type=int, default=30, help='--schedule 模式下排班的天数')
+    parser.add_argument('--iterations', type=int, default=20, help='每个页面（每个并发线程）请求的次数')
+    parser.add_argument('--concurrency', type=int, default=4, help='--url 模式下的并发线程数')
+    parser.add_argument('--username', default=ADMIN_NAME)
+    parser.add_argument('--password', default=ADMIN_PASSWORD)
+    parser.add_argument('--report-cache', action='store_true', help='保留统计结果缓存，默认关闭以测量实际查询')
+    parser.add_argument('--force', action='store_true', help='--mongo-uri 的 app 数据库不为空时仍然写入')
+    parser.add_argument('--output', help='结果保存路径，默认 bench_results/<时间>.json')
+    parser.add_argument('--compare', help='与之前保存的结果对比')
+    args = parser.parse_args()
+
+    end = datetime.now().replace(second=0, microsecond=0)
+    config = {key: value for key, value in vars(args).items() if key not in ('password', 'output', 'compare')}
+    if args.schedule:
+        sizes = [int(size) for size in args.schedule_sizes.split(',')]
+        results = bench_schedule(sizes, args.days, args.iterations, args.shifts_per_week)
+        counts = None
+    elif args.url:
+        results = bench_http(args.url.rstrip('/'), args.username, args.password, args.iterations, args.concurrency, end)
+        counts = None
+    else:
+        if args.mongo_uri:
+            os.environ['MONGO_URI'] = args.mongo_uri
+        import app
+        if args.mongomock:
+            import mongomock
+            app.db = mongomock.MongoClient()
+        elif app.db['app']['overtime'].estimated_document_count() and not args.force:
+            parser.error('app 数据库中已有数据，请使用专门的测试实例，或加 --force')
+        print('生成模拟数据...')
+        t = time.perf_counter()
+        names, counts = seed(app.db, args.staff, args.years, args.shifts_per_week, end)
+        app.db['app']['user'].insert_one({
+            'name': ADMIN_NAME, 'password': app.make_password(ADMIN_PASSWORD), 'email': 'bench@qq.com', 'permission': 'admin',
+        })
+        app.ensure_indexes()
+        app.rebuild_balances()
+        print(f'{counts} 用时 {time.perf_counter() - t:.1f}s')
+        results = bench_test_client(app, names, args.iterations, end, args.report_cache)
+
+    output = args.output or os.path.join('bench_results', datetime.now().strftime('%Y%m%d%H%M%S') + '.json')
+    os.makedirs(os.path.dirname(output) or '.', exist_ok=True)
+    with open(output, 'w', encoding='utf-8') as file:
+        json.dump({
+            'timestamp': datetime.now().isoformat(timespec='seconds'),
+            'commit': git_commit(),
+            'config': config,
+            'documents': counts,
+            'routes': results,
+        }, file, ensure_ascii=False, indent=2)
+    print(f'结果已保存到 {output}')
+    if args.compare:
+        compare(args.compare, results)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,6 +1,8 @@
+# 以单节点副本集启动，backup.py 的增量备份依赖 change stream
+# 首次启动后执行一次：sudo docker exec -it mongo mongosh --eval "rs.initiate({_id: 'rs0', members: [{_id: 0, host: 'localhost:27017'}]})"
 sudo docker run -d \
 --restart unless-stopped \
 --name mongo \
 -p 27017:27017 \
 -v $PWD/mongo:/mongo \
-mongo
+mongo --replSet rs0
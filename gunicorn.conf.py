@@ -0,0 +1,16 @@
+# gunicorn 配置：gunicorn -c gunicorn.conf.py wsgi:app
+import multiprocessing
+import os
+
+bind = os.environ.get('BIND', '0.0.0.0:80')
+workers = int(os.environ.get('WEB_CONCURRENCY', multiprocessing.cpu_count() * 2 + 1))
+threads = int(os.environ.get('WEB_THREADS', 4))
+timeout = int(os.environ.get('WEB_TIMEOUT', 60))
+# 主进程加载一次应用（检查数据库并创建索引），工作进程 fork 之后再各自创建数据库连接
+preload_app = True
+
+
+def post_fork(server, worker):
+    """每个工作进程重新创建 MongoClient，不使用从主进程复制过来的连接"""
+    import app
+    app.connect_db()
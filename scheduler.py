@@ -0,0 +1,321 @@
+"""排班：把每天各班次、各房间的岗位分配给员工
+
+硬约束：同一人每天最多一个班次，补休当天不排班，每周（从开始日期起每 7 天）加班时长不超过上限，
+两个班次之间至少休息 min_rest_hours 小时（夜班之后第二天不能再上早班或晚班）。
+目标：排班后每人的结余（调整后加班时间 + 本次排班时长）尽量接近，即结余少的人多排。
+
+先按时间顺序贪心地把每个岗位交给可以上班且结余最少的人，
+再反复尝试把岗位从结余多的人移给结余少的人，必要时把后者相邻几天冲突的岗位改给其他人，直到不能再改进。
+"""
+
+import random
+import time
+from datetime import datetime, timedelta
+
+# 班次：(开始的小时, 时长)，夜班跨到第二天
+SHIFTS = {
+    '早班': (7, 1),
+    '晚班': (17, 4),
+    '夜班': (20, 12),
+}
+# 每天各班次需要的房间
+DEMAND = {
+    '早班': ['1', '2'],
+    '晚班': ['1', '2', '3', '4'],
+    '夜班': ['1'],
+}
+MAX_WEEKLY_HOURS = 24
+MIN_REST_HOURS = 11
+# 局部搜索最多的轮数
+MAX_ROUNDS = 50
+# 每个岗位直接移交不成时，最多尝试调开冲突岗位的人数
+RELOCATE_ATTEMPTS = 5
+# 增量调整时，没人能直接顶班的岗位最多尝试调开冲突岗位的人数
+REPAIR_ATTEMPTS = 20
+# 一轮局部搜索使目标值下降的比例小于此值时停止
+CONVERGENCE = 0.001
+
+
+class Scheduler:
+    """一次排班的问题和当前的分配，岗位用在 slots 中的序号表示"""
+
+    def __init__(self, staff, start, days, balances=None, leave=None, demand=None, shifts=None,
+                 max_weekly_hours=MAX_WEEKLY_HOURS, min_rest_hours=MIN_REST_HOURS, seed=0):
+        """balances 为每人已有的结余 {名字: 小时}，leave 为每人补休的日期 {名字: [date]}"""
+        self.staff = list(staff)
+        self.start = datetime(start.year, start.month, start.day)
+        self.days = days
+        self.shifts = shifts or SHIFTS
+        self.demand = demand or DEMAND
+        self.max_weekly_hours = max_weekly_hours
+        self.min_rest_hours = min_rest_hours
+        self.random = random.Random(seed)
+        self.slots = [
+            (day, shift, room)
+            for day in range(days)
+            for shift, rooms in self.demand.items()
+            for room in rooms
+        ]
+        balances = balances or {}
+        self.balances = {name: float(balances.get(name, 0)) for name in self.staff}
+        self.leave = {name: set() for name in self.staff}
+        for name, dates in (leave or {}).items():
+            if name in self.leave:
+                for date in dates:
+                    day = (datetime(date.year, date.month, date.day) - self.start).days
+                    if 0 <= day < days:
+                        self.leave[name].add(day)
+        # 每个岗位的 (开始小时, 结束小时) 和时长，从开始日期零点算起
+        self.spans = []
+        self.lengths = []
+        for day, shift, _ in self.slots:
+            begin, hours = self.shifts[shift]
+            self.spans.append((day * 24 + begin, day * 24 + begin + hours))
+            self.lengths.append(hours)
+        self.holder = [None] * len(self.slots)
+        self.by_day = {name: {} for name in self.staff}  # 名字 -> {天: 岗位序号}
+        self.weekly = {name: {} for name in self.staff}  # 名字 -> {周: 小时}
+        self.hours = {name: 0.0 for name in self.staff}
+
+    def slot_hours(self, index):
+        return self.lengths[index]
+
+    def slot_span(self, index):
+        """岗位从开始日期零点算起的开始和结束小时"""
+        return self.spans[index]
+
+    def load(self, name):
+        """排班后的结余"""
+        return self.balances[name] + self.hours[name]
+
+    def feasible(self, name, index, ignore=None):
+        """name 能否上 index 这个岗位，ignore 是此人将要让出的岗位"""
+        day = self.slots[index][0]
+        begin, end = self.spans[index]
+        if day in self.leave[name] or (end > (day + 1) * 24 and day + 1 in self.leave[name]):
+            return False
+        own = self.by_day[name]
+        if own.get(day, ignore) != ignore:
+            return False
+        week_hours = self.weekly[name].get(day // 7, 0.0)
+        if ignore is not None and self.slots[ignore][0] // 7 == day // 7:
+            week_hours -= self.lengths[ignore]
+        if week_hours + self.lengths[index] > self.max_weekly_hours:
+            return False
+        previous = own.get(day - 1)
+        if previous is not None and previous != ignore and self.spans[previous][1] + self.min_rest_hours > begin:
+            return False
+        following = own.get(day + 1)
+        if following is not None and following != ignore and end + self.min_rest_hours > self.spans[following][0]:
+            return False
+        return True
+
+    def assign(self, index, name):
+        day = self.slots[index][0]
+        hours = self.slot_hours(index)
+        self.holder[index] = name
+        self.by_day[name][day] = index
+        self.weekly[name][day // 7] = self.weekly[name].get(day // 7, 0.0) + hours
+        self.hours[name] += hours
+
+    def unassign(self, index):
+        name = self.holder[index]
+        day = self.slots[index][0]
+        hours = self.slot_hours(index)
+        self.holder[index] = None
+        del self.by_day[name][day]
+        self.weekly[name][day // 7] -= hours
+        self.hours[name] -= hours
+        return name
+
+    def fill(self):
+        """按天把空着的岗位交给可以上班且结余最少的人，返回填上的个数
+
+        每人每天最多一个班次，当天排过的人不会再被选中，所以每天开始时按结余排一次序就够了。
+        """
+        filled = 0
+        day = None
+        for index, name in enumerate(self.holder):
+            if name is not None:
+                continue
+            if self.slots[index][0] != day:
+                day = self.slots[index][0]
+                order = sorted(self.staff, key=lambda candidate: (self.load(candidate), self.random.random()))
+            for candidate in order:
+                if self.feasible(candidate, index):
+                    self.assign(index, candidate)
+                    filled += 1
+                    break
+        return filled
+
+    def relocate(self, index, candidate, order, improve=True):
+        """把岗位交给 candidate，candidate 前一天、当天、后一天与之冲突的岗位改给其他可以上班且结余较少的人，
+        improve 为 True 时所有涉及的人结余的平方和下降才保留，为 False 时都能排上就保留，否则撤销"""
+        day = self.slots[index][0]
+        own = self.by_day[candidate]
+        conflicts = [own[d] for d in (day - 1, day, day + 1) if d in own]
+        before = {name: self.load(name) for name in (self.holder[index], candidate) if name is not None}
+        log = []  # (岗位, 原来的人)，撤销时倒序恢复
+
+        def move(slot, name):
+            log.append((slot, self.holder[slot]))
+            if self.holder[slot] is not None:
+                self.unassign(slot)
+            if name is not None:
+                self.assign(slot, name)
+
+        for slot in conflicts:
+            move(slot, None)
+        move(index, None)
+        ok = self.feasible(candidate, index)
+        if ok:
+            move(index, candidate)
+            for slot in conflicts:
+                # 按本轮开始时的结余顺序找第一个可以上班的人
+                name = next((name for name in order if name != candidate and self.feasible(name, slot)), None)
+                if name is None:
+                    ok = False
+                    break
+                before.setdefault(name, self.load(name))
+                move(slot, name)
+        if ok and (not improve or sum(self.load(name) ** 2 for name in before) < sum(load ** 2 for load in before.values()) - 1e-9):
+            return True
+        for slot, name in reversed(log):
+            if self.holder[slot] is not None:
+                self.unassign(slot)
+            if name is not None:
+                self.assign(slot, name)
+        return False
+
+    def improve_slot(self, index, order, loads):
+        """尝试把岗位交给结余更少的人，平方和下降时才改动
+
+        order 是本轮开始时按结余排好的名单，loads 是当时的结余，用来尽早结束查找。
+        """
+        holder = self.holder[index]
+        hours = self.slot_hours(index)
+        holder_load = self.load(holder)
+        attempts = 0
+        for candidate in order:
+            if loads[candidate] + hours >= holder_load:
+                break
+            if candidate == holder or self.load(candidate) + hours >= holder_load:
+                continue
+            if self.feasible(candidate, index):
+                self.unassign(index)
+                self.assign(index, candidate)
+                return True
+            if attempts < RELOCATE_ATTEMPTS:
+                attempts += 1
+                if self.relocate(index, candidate, order):
+                    return True
+        return False
+
+    def solve(self, max_rounds=MAX_ROUNDS, time_limit=None):
+        """贪心填满后局部搜索，返回进行的轮数"""
+        deadline = time.perf_counter() + time_limit if time_limit else None
+        self.fill()
+        rounds = 0
+        objective = self.objective()
+        for rounds in range(1, max_rounds + 1):
+            improved = False
+            loads = {name: self.load(name) for name in self.staff}
+            order = sorted(self.staff, key=loads.get)
+            indexes = [index for index, name in enumerate(self.holder) if name is not None]
+            self.random.shuffle(indexes)
+            for index in indexes:
+                if self.improve_slot(index, order, loads):
+                    improved = True
+                if deadline and time.perf_counter() > deadline:
+                    break
+            # 移动之后有人空出了时间，原来排不上的岗位可能可以排了
+            if self.fill():
+                improved = True
+            # 一轮下来改进很小时不再继续
+            previous, objective = objective, self.objective()
+            if not improved or previous - objective < previous * CONVERGENCE or (deadline and time.perf_counter() > deadline):
+                break
+        return rounds
+
+    def objective(self):
+        """排班后结余与平均值之差的平方和，越小越平均"""
+        loads = [self.load(name) for name in self.staff]
+        if not loads:
+            return 0.0
+        mean = sum(loads) / len(loads)
+        return sum((load - mean) ** 2 for load in loads)
+
+    def restore(self, assignments):
+        """按保存的分配结果 assignments() 恢复，不在名单中的人和同一天的第二个班次留空"""
+        indexes = {slot: index for index, slot in enumerate(self.slots)}
+        for item in assignments:
+            index = indexes.get(((item['date'] - self.start).days, item['shift'], item['room']))
+            name = item['name']
+            if index is not None and name in self.by_day and self.slots[index][0] not in self.by_day[name]:
+                self.assign(index, name)
+
+    def violations(self):
+        """已分配但与请假、休息时间或每周上限冲突的岗位"""
+        return [
+            index for index, name in enumerate(self.holder)
+            if name is not None and not self.feasible(name, index, ignore=index)
+        ]
+
+    def repair(self, unavailable=None):
+        """增量调整：把 unavailable {名字: [date]} 加入请假，只把因此冲突的岗位重新排上，其余分配不变
+
+        先找可以直接上班且结余最少的人，没有时才把某人相邻几天冲突的岗位改给其他人。
+        返回改动过的岗位 [(序号, 原来的人, 现在的人)]。
+        """
+        for name, dates in (unavailable or {}).items():
+            if name in self.leave:
+                for date in dates:
+                    day = (datetime(date.year, date.month, date.day) - self.start).days
+                    if 0 <= day < self.days:
+                        self.leave[name].add(day)
+        before = list(self.holder)
+        freed = self.violations()
+        for index in freed:
+            self.unassign(index)
+        for index in freed:
+            order = sorted(self.staff, key=self.load)
+            name = next((name for name in order if self.feasible(name, index)), None)
+            if name is not None:
+                self.assign(index, name)
+                continue
+            for name in order[:REPAIR_ATTEMPTS]:
+                if self.relocate(index, name, order, improve=False):
+                    break
+        return [(index, before[index], name) for index, name in enumerate(self.holder) if before[index] != name]
+
+    def unfilled(self):
+        return [index for index, name in enumerate(self.holder) if name is None]
+
+    def spread(self):
+        """排班后结余的最大差值"""
+        loads = [self.load(name) for name in self.staff]
+        return max(loads) - min(loads) if loads else 0.0
+
+    def assignments(self):
+        """按日期、班次、房间排列的分配结果"""
+        result = []
+        for index, (day, shift, room) in enumerate(self.slots):
+            begin, end = self.slot_span(index)
+            result.append({
+                'date': self.start + timedelta(days=day),
+                'shift': shift,
+                'room': room,
+                'name': self.holder[index],
+                'start_time': self.start + timedelta(hours=begin),
+                'end_time': self.start + timedelta(hours=end),
+                'hours': float(self.slot_hours(index)),
+            })
+        return result
+
+    def totals(self):
+        """每人的原有结余、排班时长和排班后的结余，按排班后的结余排序"""
+        return sorted(
+            ({'name': name, 'balance': round(self.balances[name], 1), 'hours': self.hours[name], 'total': round(self.load(name), 1)}
+             for name in self.staff),
+            key=lambda item: (item['total'], item['name']),
+        )
@@ -0,0 +1,86 @@
+"""加班时段分类：按开始和结束时间把加班分为日间、早间、晚间、跨夜和跨多天，一次处理一批记录
+
+时段按医院当地时间判断。本系统写入的时间都是不带时区的当地时间，直接判断即可；
+按 UTC 保存的时间传入 tz，先换算成当地时间再判断，否则 8 点、17 点、22 点的界限会差一个时区偏移。
+
+与原来逐条判断的规则相同：开始和结束不在同一天的算跨夜（跨多天），
+同一天的晚于下班时间下班算晚间，否则早于 EARLY_HOUR 上班算早间。
+"""
+
+import os
+from datetime import datetime, timedelta, timezone
+from zoneinfo import ZoneInfo
+
+import numpy as np
+
+HOSPITAL_TIMEZONE = ZoneInfo(os.environ.get('HOSPITAL_TIMEZONE', 'Asia/Shanghai'))
+# 早于这个时间上班算早间
+EARLY_HOUR = 8
+# 晚于这个时间下班算晚间，统计页面可以另外指定
+LATE_HOUR = 17
+
+REGULAR = 0
+EARLY = 1
+LATE = 2
+OVERNIGHT = 3  # 结束在开始的第二天
+MULTI_DAY = 4  # 结束在开始两天以后
+LABELS = {REGULAR: '日间', EARLY: '早间', LATE: '晚间', OVERNIGHT: '跨夜', MULTI_DAY: '跨多天'}
+
+HOUR = np.timedelta64(1, 'h')
+EPOCH = datetime(1970, 1, 1)
+MICROSECOND = timedelta(microseconds=1)
+
+
+def to_array(values):
+    """不带时区的 datetime 序列转换为 datetime64[us] 数组
+
+    numpy 逐个解析 datetime 对象很慢，先换算成整数微秒再转换。
+    """
+    if isinstance(values, np.ndarray):
+        return values.astype('datetime64[us]')
+    return np.array([(value - EPOCH) // MICROSECOND for value in values], dtype=np.int64).view('datetime64[us]')
+
+
+def to_local(values, tz=HOSPITAL_TIMEZONE):
+    """把 UTC 时间数组换算成 tz 的当地时间
+
+    每个不同的整点只查一次 UTC 偏移，夏令时切换的前后也能正确换算。
+    """
+    values = to_array(values)
+    if not values.size:
+        return values
+    hours, inverse = np.unique(values.astype('datetime64[h]'), return_inverse=True)
+    offsets = np.array([
+        hour.item().replace(tzinfo=timezone.utc).astimezone(tz).utcoffset() for hour in hours
+    ], dtype='timedelta64[us]')
+    return values + offsets[inverse.reshape(values.shape)]
+
+
+def classify(start, end, late_hour=LATE_HOUR, early_hour=EARLY_HOUR, tz=None):
+    """start、end 为同样长度的时间数组，返回每条记录的时段（int8 数组）
+
+    tz 不为 None 时 start、end 是 UTC 时间，先换算成 tz 的当地时间。
+    """
+    start, end = to_array(start), to_array(end)
+    if tz is not None:
+        start, end = to_local(start, tz), to_local(end, tz)
+    start_day = start.astype('datetime64[D]')
+    end_day = end.astype('datetime64[D]')
+    days = (end_day - start_day).astype(np.int64)
+    result = np.full(start.shape, REGULAR, dtype=np.int8)
+    # 晚间优先于早间
+    result[start - start_day < early_hour * HOUR] = EARLY
+    result[end - end_day > late_hour * HOUR] = LATE
+    result[days == 1] = OVERNIGHT
+    # 结束早于开始的异常数据也不在同一天，与原来的判断一样计入
+    result[(days > 1) | (days < 0)] = MULTI_DAY
+    return result
+
+
+def count_by_name(names, counted):
+    """counted 为 True 的记录按名字计数，返回 {名字: 次数}"""
+    names = np.asarray(names, dtype=object)[np.asarray(counted, dtype=bool)]
+    if not names.size:
+        return {}
+    unique, counts = np.unique(names, return_counts=True)
+    return dict(zip(unique.tolist(), counts.tolist()))
@@ -0,0 +1,19 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+@pytest.fixture
+def app_module(monkeypatch):
+    """使用内存中 mongomock 数据库的 app 模块，每个测试一个空库"""
+    mongomock = pytest.importorskip('mongomock')
+    import app
+    monkeypatch.setattr(app, 'db', mongomock.MongoClient())
+    monkeypatch.setitem(app._archive_state, 'checked', 0.0)
+    monkeypatch.setitem(app._report_versions, 'months', None)
+    monkeypatch.setitem(app._report_versions, 'checked', 0.0)
+    app.report_cache.invalidate([(app.datetime.min, app.datetime.max)])
+    return app
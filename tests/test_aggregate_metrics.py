@@ -0,0 +1,71 @@
+"""聚合耗时包括读取游标的整个过程，慢查询在后台线程中 explain"""
+
+import time
+
+
+def aggregate_count(app_module):
+    key = ('mongo_aggregate_duration_seconds', (('collection', 'overtime'),))
+    return app_module.metrics._histograms.get(key, [0])[-1]
+
+
+def wait_for_slow_queries(app_module):
+    """后台线程只有一个，排在后面的任务完成时之前的都已完成"""
+    app_module.slow_query_executor.submit(lambda: None).result()
+
+
+def test_duration_recorded_once_after_cursor_is_exhausted(app_module, monkeypatch):
+    app_module.db['app']['overtime'].insert_many([{'name': str(i), 'hours': 1.0} for i in range(5)])
+    slow = []
+    monkeypatch.setattr(app_module, 'log_slow_query', lambda collection, pipeline, elapsed, explain=True: slow.append(elapsed))
+    monkeypatch.setattr(app_module, 'SLOW_QUERY_MS', 50)
+    before = aggregate_count(app_module)
+
+    cursor = app_module.aggregate('overtime', [{'$match': {}}])
+    original = cursor._cursor
+
+    class SlowCursor:
+        """模拟每次 getMore 都要等待的游标"""
+        def __next__(self):
+            time.sleep(0.02)
+            return next(original)
+
+    cursor._cursor = SlowCursor()
+    assert len(list(cursor)) == 5
+    assert aggregate_count(app_module) == before + 1
+    wait_for_slow_queries(app_module)
+    assert len(slow) == 1 and slow[0] >= 0.1
+
+    # 再次读取或回收时不会重复记录
+    assert list(cursor) == []
+    del cursor
+    assert aggregate_count(app_module) == before + 1
+    wait_for_slow_queries(app_module)
+    assert len(slow) == 1
+
+
+def test_duration_recorded_when_cursor_is_abandoned(app_module):
+    app_module.db['app']['overtime'].insert_many([{'name': str(i), 'hours': 1.0} for i in range(5)])
+    before = aggregate_count(app_module)
+    first = next(app_module.aggregate('overtime', [{'$match': {}}]))
+    assert first['hours'] == 1.0
+    assert aggregate_count(app_module) == before + 1
+
+
+def test_abandoned_slow_cursor_is_explained_later_in_background(app_module, monkeypatch):
+    app_module.db['app']['overtime'].insert_many([{'name': str(i), 'hours': 1.0} for i in range(5)])
+    slow = []
+    monkeypatch.setattr(app_module, 'log_slow_query', lambda collection, pipeline, elapsed, explain=True: slow.append((pipeline, explain)))
+    monkeypatch.setattr(app_module, 'SLOW_QUERY_MS', 0)
+    app_module._slow_queries.clear()
+
+    cursor = app_module.aggregate('overtime', [{'$match': {'hours': 1.0}}])
+    next(cursor)
+    del cursor
+    # 回收时只记录耗时，不 explain 也不写日志
+    assert slow == []
+    assert len(app_module._slow_queries) == 1
+
+    list(app_module.aggregate('overtime', [{'$match': {}}]))
+    wait_for_slow_queries(app_module)
+    assert slow == [([{'$match': {'hours': 1.0}}], True), ([{'$match': {}}], True)]
+    assert not app_module._slow_queries
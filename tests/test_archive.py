@@ -0,0 +1,61 @@
+"""归档期间原集合和归档集合中的同一条记录只统计一次"""
+
+from datetime import datetime, timedelta
+
+import pytest
+
+
+def run(app_module, collection, pipeline):
+    """mongomock 不支持 $unionWith，按顺序分别执行原集合和各归档集合的部分"""
+    database = app_module.db['app']
+    head = [stage for stage in pipeline if '$unionWith' not in stage]
+    docs = list(database[collection].aggregate(head))
+    for stage in pipeline:
+        if '$unionWith' in stage:
+            docs += list(database[stage['$unionWith']['coll']].aggregate(stage['$unionWith']['pipeline']))
+    return docs
+
+
+def record(start_time):
+    return {'name': '甲', 'start_time': start_time, 'end_time': start_time + timedelta(hours=2), 'hours': 2.0, 'verify': True}
+
+
+@pytest.fixture
+def mid_archive(app_module):
+    """截止时间从 2022-03-01 移到 2022-07-01 的过程中：新的一段已经复制到 overtime_2022，还没有从原集合删除"""
+    database = app_module.db['app']
+    old_cutoff, new_cutoff = datetime(2022, 3, 1), datetime(2022, 7, 1)
+    archived = [record(datetime(2022, 1, 1) + timedelta(days=day)) for day in range(0, 59, 3)]
+    copied = [record(datetime(2022, 3, 1) + timedelta(days=day)) for day in range(0, 122, 3)]
+    hot = [record(datetime(2022, 7, 1) + timedelta(days=day)) for day in range(0, 60, 3)]
+    database['overtime_2022'].insert_many([dict(item) for item in archived + copied])
+    database['overtime'].insert_many([dict(item) for item in copied + hot])
+    return old_cutoff, new_cutoff, len(archived) + len(copied) + len(hot)
+
+
+@pytest.mark.parametrize('published', [False, True])
+def test_each_record_counted_once_during_archive(app_module, mid_archive, published):
+    old_cutoff, new_cutoff, total = mid_archive
+    cutoff = new_cutoff if published else old_cutoff
+    app_module.db['app']['meta'].insert_one({'_id': 'archive', 'cutoff': cutoff, 'first_year': 2022})
+    date1, date2 = datetime(2022, 1, 1), datetime(2022, 9, 1)
+
+    pipeline = app_module.with_archives('overtime', date1, date2, [
+        {'$match': {'start_time': {'$gte': date1, '$lt': date2}, 'verify': True}},
+    ])
+    docs = run(app_module, 'overtime', pipeline)
+    assert len(docs) == total
+    assert len({item['start_time'] for item in docs}) == total
+
+
+def test_first_year_backfilled_from_existing_archives(app_module):
+    database = app_module.db['app']
+    database['overtime_2019'].insert_one(record(datetime(2019, 5, 1)))
+    database['writeoff_2018'].insert_one({'name': '甲', 'date': datetime(2018, 5, 1), 'hours': 1.0, 'verify': True})
+    database['meta'].insert_one({'_id': 'archive', 'cutoff': datetime(2021, 1, 1)})
+
+    assert app_module.archive_cutoff() == datetime(2021, 1, 1)
+    assert app_module._archive_state['first_year'] == 2018
+    assert database['meta'].find_one({'_id': 'archive'})['first_year'] == 2018
+    pipeline = app_module.with_archives('overtime', datetime(2000, 1, 1), datetime(2021, 6, 1), [{'$match': {}}])
+    assert [stage['$unionWith']['coll'] for stage in pipeline if '$unionWith' in stage] == ['overtime_2018', 'overtime_2019', 'overtime_2020']
@@ -0,0 +1,11 @@
+"""单条插入按是否抛出写入异常判断成功与否"""
+
+from datetime import datetime
+
+
+def test_insert_record_reports_write_errors(app_module):
+    record = {'name': '甲', 'date': datetime(2024, 1, 15), 'hours': 2.0, 'verify': False}
+    assert app_module.insert_record('writeoff', record) is True
+    # 重复的 _id 会被服务器拒绝
+    assert app_module.insert_record('writeoff', dict(record)) is False
+    assert app_module.db['app']['writeoff'].count_documents({}) == 1
@@ -0,0 +1,56 @@
+"""同一人同时提交重叠的时间段时只有一条能插入"""
+
+import threading
+from datetime import datetime, timedelta
+
+
+def overtime(name, start_time, hours=2):
+    return {'name': name, 'start_time': start_time, 'end_time': start_time + timedelta(hours=hours), 'hours': float(hours), 'verify': False}
+
+
+def test_concurrent_overlapping_submissions_insert_once(app_module, monkeypatch):
+    start = datetime(2024, 1, 2, 8)
+    original = app_module.find_conflicts
+    barrier = threading.Barrier(8)
+
+    def slow_find_conflicts(records):
+        # 让所有线程都在检查和插入之间停留，没有锁时都会通过检查
+        result = original(records)
+        threading.Event().wait(0.05)
+        return result
+
+    monkeypatch.setattr(app_module, 'find_conflicts', slow_find_conflicts)
+    results = []
+
+    def submit(offset):
+        barrier.wait()
+        results.append(app_module.insert_records('overtime', [overtime('甲', start + timedelta(minutes=offset))]))
+
+    threads = [threading.Thread(target=submit, args=(offset,)) for offset in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert sorted(number for number, _ in results) == [0] * 7 + [1]
+    assert app_module.db['app']['overtime'].count_documents({'name': '甲'}) == 1
+    assert app_module.db['app']['locks'].count_documents({}) == 0
+
+
+def test_lock_held_by_another_submission_times_out(app_module, monkeypatch):
+    monkeypatch.setattr(app_module, 'INTERVAL_LOCK_WAIT', 0.2)
+    app_module.db['app']['locks'].insert_one({'_id': 'interval:甲', 'owner': 'other', 'expires': datetime.now() + timedelta(minutes=1)})
+
+    number, errors = app_module.insert_records('overtime', [overtime('甲', datetime(2024, 1, 2, 8)), overtime('乙', datetime(2024, 1, 2, 8))])
+    assert number == 0
+    assert [index for index, _ in errors] == [0, 1]
+    assert app_module.db['app']['locks'].count_documents({'_id': 'interval:乙'}) == 0
+    assert app_module.insert_interval('overtime', overtime('甲', datetime(2024, 1, 3, 8))) == '有其他提交正在处理，请重试！'
+
+
+def test_expired_lock_is_taken_over(app_module):
+    app_module.db['app']['locks'].insert_one({'_id': 'interval:甲', 'owner': 'crashed', 'expires': datetime.now() - timedelta(seconds=1)})
+
+    assert app_module.insert_interval('overtime', overtime('甲', datetime(2024, 1, 2, 8))) == '数据上传成功！'
+    assert app_module.insert_interval('compensation', overtime('甲', datetime(2024, 1, 2, 9))).startswith('时间与已有的加班')
+    assert app_module.db['app']['locks'].count_documents({}) == 0
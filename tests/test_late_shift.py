@@ -0,0 +1,115 @@
+"""数据库中的晚班次数统计与原来逐条判断、shifts.classify 的结果一致"""
+
+import random
+from datetime import datetime, timedelta
+
+import pytest
+
+import shifts
+
+
+def per_row_rule(start_time, end_time, cutoff_hour):
+    """原 report() 中逐条判断的规则"""
+    if start_time.month == end_time.month and start_time.day == end_time.day:
+        if end_time > datetime(end_time.year, end_time.month, end_time.day, cutoff_hour, 0):
+            return True
+        elif start_time < datetime(start_time.year, start_time.month, start_time.day, 8, 0):
+            return True
+        return False
+    return True
+
+
+def per_row_counts(records, date1, date2, cutoff_hour):
+    counts = {}
+    for record in records:
+        if record['verify'] and date1 <= record['start_time'] < date2 and per_row_rule(record['start_time'], record['end_time'], cutoff_hour):
+            counts[record['name']] = counts.get(record['name'], 0) + 1
+    return counts
+
+
+def classify_counts(records, date1, date2, cutoff_hour, tz=None):
+    selected = [record for record in records if record['verify'] and date1 <= record['start_time'] < date2]
+    periods = shifts.classify(
+        [record['start_time'] for record in selected], [record['end_time'] for record in selected],
+        late_hour=cutoff_hour, tz=tz,
+    )
+    return shifts.count_by_name([record['name'] for record in selected], periods != shifts.REGULAR)
+
+
+def pipeline_counts(app_module, date1, date2, cutoff_hour, name=None):
+    pipeline = app_module.late_shift_pipeline(date1, date2, cutoff_hour, name)
+    return [(item['_id'], item['count']) for item in app_module.aggregate('overtime', pipeline)]
+
+
+def boundary_records(day):
+    """07:59:59、正好在下班时间或晚 1 毫秒（BSON 只保存到毫秒）、零点结束和跨天的记录"""
+    spans = [
+        (timedelta(hours=7, minutes=59, seconds=59), timedelta(hours=9)),
+        (timedelta(hours=8), timedelta(hours=10)),
+        (timedelta(hours=14), timedelta(hours=17)),
+        (timedelta(hours=14), timedelta(hours=17, milliseconds=1)),
+        (timedelta(hours=18), timedelta(hours=22)),
+        (timedelta(hours=18), timedelta(hours=22, seconds=1)),
+        (timedelta(hours=20), timedelta(hours=23)),
+        (timedelta(hours=20), timedelta(hours=23, minutes=59, seconds=59)),
+        (timedelta(hours=16), timedelta(days=1)),
+        (timedelta(hours=22), timedelta(days=1, hours=6)),
+        (timedelta(0), timedelta(hours=1)),
+    ]
+    return [
+        {'name': f'边界{i}', 'start_time': day + start, 'end_time': day + end, 'hours': 1.0, 'verify': True}
+        for i, (start, end) in enumerate(spans)
+    ]
+
+
+def random_records(count):
+    rng = random.Random(0)
+    records = []
+    for _ in range(count):
+        start = datetime(2023, 12, 20) + timedelta(minutes=rng.randrange(0, 40 * 24 * 60), seconds=rng.choice([0, 0, 59]))
+        end = start + timedelta(minutes=rng.randrange(1, 12 * 60 + 1))
+        records.append({'name': rng.choice('甲乙丙丁戊'), 'start_time': start, 'end_time': end, 'hours': 1.0, 'verify': rng.random() < 0.8})
+    return records
+
+
+@pytest.mark.parametrize('cutoff_hour', [0, 8, 17, 22, 23])
+def test_late_shift_pipeline_matches_per_row_rule(app_module, cutoff_hour):
+    records = random_records(2000)
+    for day in (datetime(2023, 12, 31), datetime(2024, 1, 15), datetime(2024, 2, 29)):
+        records += boundary_records(day)
+    app_module.db['app']['overtime'].insert_many([dict(record) for record in records])
+    date1, date2 = datetime(2023, 12, 25), datetime(2024, 3, 1)
+
+    expected = per_row_counts(records, date1, date2, cutoff_hour)
+    assert classify_counts(records, date1, date2, cutoff_hour) == expected
+    assert dict(pipeline_counts(app_module, date1, date2, cutoff_hour)) == expected
+
+
+@pytest.mark.parametrize('cutoff_hour', [17, 22])
+def test_late_shift_pipeline_converts_utc_records(app_module, monkeypatch, cutoff_hour):
+    monkeypatch.setattr(app_module, 'RECORDS_IN_UTC', True)
+    records = random_records(2000) + [
+        # 当地时间 18:00-23:00，按 UTC 判断则是 10:00-15:00 的日间加班
+        {'name': '时区', 'start_time': datetime(2024, 1, 15, 10), 'end_time': datetime(2024, 1, 15, 15), 'hours': 5.0, 'verify': True},
+    ]
+    app_module.db['app']['overtime'].insert_many([dict(record) for record in records])
+    date1, date2 = datetime(2023, 12, 25), datetime(2024, 3, 1)
+
+    expected = classify_counts(records, date1, date2, cutoff_hour, tz=shifts.HOSPITAL_TIMEZONE)
+    assert expected['时区'] == 1
+    assert dict(pipeline_counts(app_module, date1, date2, cutoff_hour)) == expected
+
+
+def test_late_shift_report_filters_by_name_and_sorts(app_module):
+    records = boundary_records(datetime(2024, 1, 15)) + [
+        {'name': '边界0', 'start_time': datetime(2024, 1, 16, 6), 'end_time': datetime(2024, 1, 16, 9), 'hours': 3.0, 'verify': True},
+    ]
+    app_module.db['app']['overtime'].insert_many(records)
+    date1, date2 = datetime(2024, 1, 1), datetime(2024, 2, 1)
+
+    header, rows = app_module.build_report('17点以后加班次数统计', date1, date2, cutoff_hour=17)
+    assert header == ['名字', '次数']
+    assert rows[0] == ['边界0', 2]
+    assert [count for _, count in rows] == sorted((count for _, count in rows), reverse=True)
+    assert pipeline_counts(app_module, date1, date2, 17, name='边界2') == []
+    assert pipeline_counts(app_module, date1, date2, 17, name='边界3') == [('边界3', 1)]
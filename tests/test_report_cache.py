@@ -0,0 +1,45 @@
+"""其他进程的写入通过各月份的版本号使本进程的统计结果缓存失效"""
+
+from datetime import datetime
+
+
+def cached_keys(app_module):
+    return set(app_module.report_cache._entries)
+
+
+def fill_cache(app_module):
+    app_module.report_cache.put('一月', datetime(2024, 1, 1), datetime(2024, 2, 1), 'a')
+    app_module.report_cache.put('二月', datetime(2024, 2, 1), datetime(2024, 3, 1), 'b')
+    app_module.report_cache.put('全年', datetime(2024, 1, 1), datetime(2025, 1, 1), 'c')
+
+
+def test_reports_changed_bumps_every_month_in_the_span(app_module):
+    app_module.reports_changed([(datetime(2024, 1, 31, 22), datetime(2024, 3, 1, 6))])
+    app_module.reports_changed([(datetime(2024, 3, 5), datetime(2024, 3, 5))])
+    state = app_module.db['app']['meta'].find_one({'_id': 'report_version'})
+    assert state['months'] == {'2024-01': 1, '2024-02': 1, '2024-03': 2}
+
+
+def test_write_in_another_process_invalidates_only_affected_months(app_module, monkeypatch):
+    app_module.sync_report_cache()
+    fill_cache(app_module)
+
+    # 其他进程写入了 2024 年 2 月的记录
+    app_module.db['app']['meta'].update_one({'_id': 'report_version'}, {'$inc': {'months.2024-02': 1}}, upsert=True)
+    app_module.sync_report_cache()
+    assert cached_keys(app_module) == {'一月', '二月', '全年'}, '检查间隔内不重新读取版本号'
+
+    monkeypatch.setitem(app_module._report_versions, 'checked', 0.0)
+    app_module.sync_report_cache()
+    assert cached_keys(app_module) == {'一月'}
+
+    # 版本号没有变化时保留缓存
+    monkeypatch.setitem(app_module._report_versions, 'checked', 0.0)
+    app_module.sync_report_cache()
+    assert cached_keys(app_module) == {'一月'}
+
+
+def test_cache_filled_before_first_version_check_is_dropped(app_module):
+    fill_cache(app_module)
+    app_module.sync_report_cache()
+    assert cached_keys(app_module) == set()
@@ -0,0 +1,25 @@
+"""排班页面的输入检查"""
+
+import pytest
+
+
+@pytest.fixture
+def admin_client(app_module):
+    app_module.app.config['WTF_CSRF_ENABLED'] = False
+    app_module.db['app']['user'].insert_one({'name': 'admin', 'password': app_module.make_password('pw'), 'email': 'a@qq.com', 'permission': 'admin'})
+    client = app_module.app.test_client()
+    client.post('/login', data={'action': 'login', 'username': 'admin', 'password': 'pw'})
+    return client
+
+
+@pytest.mark.parametrize('start', ['', '2026-13-01', 'abc'])
+def test_invalid_start_date_is_flashed(admin_client, start):
+    response = admin_client.post('/schedule', data={'start': start, 'days': '7', 'max_weekly_hours': '24'}, follow_redirects=True)
+    assert response.status_code == 200
+    assert '开始日期输入有误' in response.get_data(as_text=True)
+
+
+def test_missing_start_date_is_flashed(admin_client):
+    response = admin_client.post('/schedule', data={'days': '7', 'max_weekly_hours': '24'}, follow_redirects=True)
+    assert response.status_code == 200
+    assert '开始日期输入有误' in response.get_data(as_text=True)
@@ -0,0 +1,112 @@
+"""shifts.classify 与原来逐条判断的结果一致，按 UTC 传入时换算成当地时间后结果不变"""
+
+import random
+from datetime import datetime, timedelta, timezone
+from zoneinfo import ZoneInfo
+
+import pytest
+
+np = pytest.importorskip('numpy')
+import shifts
+
+
+def per_row_rule(start_time, end_time, cutoff_hour):
+    """原 report() 中逐条判断的规则"""
+    if start_time.month == end_time.month and start_time.day == end_time.day:
+        if end_time > datetime(end_time.year, end_time.month, end_time.day, cutoff_hour, 0):
+            return True
+        elif start_time < datetime(start_time.year, start_time.month, start_time.day, 8, 0):
+            return True
+        return False
+    return True
+
+
+def local_records():
+    rng = random.Random(0)
+    records = []
+    for _ in range(20000):
+        start = datetime(2019, 1, 1) + timedelta(
+            minutes=rng.randrange(0, 6 * 365 * 24 * 60),
+            seconds=rng.choice([0, 0, rng.randrange(60)]),
+            microseconds=rng.choice([0, 0, 1, 999999]),
+        )
+        records.append((rng.choice('甲乙丙丁'), start, start + timedelta(minutes=rng.randrange(1, 12 * 60 + 1))))
+    for day in (datetime(2020, 2, 29), datetime(2023, 12, 31), datetime(2024, 3, 10)):
+        for start, end in [
+            (timedelta(hours=7, minutes=59, seconds=59, microseconds=999999), timedelta(hours=9)),
+            (timedelta(hours=8), timedelta(hours=17)),
+            (timedelta(hours=8), timedelta(hours=17, microseconds=1)),
+            (timedelta(hours=16), timedelta(hours=22)),
+            (timedelta(hours=16), timedelta(hours=22, microseconds=1)),
+            (timedelta(hours=20), timedelta(hours=23)),
+            (timedelta(hours=12), timedelta(hours=23, minutes=59, seconds=59, microseconds=999999)),
+            (timedelta(hours=20), timedelta(days=1)),
+            (timedelta(hours=22), timedelta(days=1, hours=6)),
+            (timedelta(0), timedelta(hours=1)),
+        ]:
+            records.append(('边界', day + start, day + end))
+    return records
+
+
+RECORDS = local_records()
+
+
+@pytest.mark.parametrize('cutoff_hour', [0, 17, 22, 23])
+def test_classify_matches_per_row_rule(cutoff_hour):
+    names, starts, ends = zip(*RECORDS)
+    periods = shifts.classify(starts, ends, late_hour=cutoff_hour)
+
+    expected = [per_row_rule(start, end, cutoff_hour) for _, start, end in RECORDS]
+    assert (periods != shifts.REGULAR).tolist() == expected
+
+    counts = {}
+    for (name, _, _), counted in zip(RECORDS, expected):
+        if counted:
+            counts[name] = counts.get(name, 0) + 1
+    assert shifts.count_by_name(names, periods != shifts.REGULAR) == counts
+
+
+def test_classify_categories():
+    day = datetime(2024, 1, 15)
+    starts = [day + timedelta(hours=9), day + timedelta(hours=7), day + timedelta(hours=7), day + timedelta(hours=20), day + timedelta(hours=20)]
+    ends = [day + timedelta(hours=12), day + timedelta(hours=9), day + timedelta(hours=18), day + timedelta(days=1, hours=2), day + timedelta(days=2, hours=2)]
+    assert shifts.classify(starts, ends).tolist() == [shifts.REGULAR, shifts.EARLY, shifts.LATE, shifts.OVERNIGHT, shifts.MULTI_DAY]
+
+
+def test_empty_batch():
+    assert shifts.classify([], []).size == 0
+    assert shifts.count_by_name([], []) == {}
+
+
+def is_unambiguous(value, tz):
+    """夏令时切换时不存在或出现两次的当地时间无法唯一换算成 UTC，不参与比较"""
+    aware = value.replace(tzinfo=tz)
+    return (
+        aware.utcoffset() == value.replace(tzinfo=tz, fold=1).utcoffset()
+        and aware.astimezone(timezone.utc).astimezone(tz).replace(tzinfo=None) == value
+    )
+
+
+@pytest.mark.parametrize('zone', ['Asia/Shanghai', 'America/New_York', 'Europe/Berlin'])
+def test_utc_input_matches_local_time(zone):
+    tz = ZoneInfo(zone)
+    records = [(start, end) for _, start, end in RECORDS if is_unambiguous(start, tz) and is_unambiguous(end, tz)]
+    to_utc = lambda value: value.replace(tzinfo=tz).astimezone(timezone.utc).replace(tzinfo=None)
+
+    local = shifts.classify([start for start, _ in records], [end for _, end in records])
+    converted = shifts.classify([to_utc(start) for start, _ in records], [to_utc(end) for _, end in records], tz=tz)
+    assert (local == converted).all()
+
+
+def test_utc_conversion_across_dst_change():
+    tz = ZoneInfo('America/New_York')
+    # 2024-03-10 02:00 起为夏令时（UTC-4），之前为 UTC-5
+    assert shifts.to_local([datetime(2024, 3, 10, 6, 59), datetime(2024, 3, 10, 7, 0)], tz).tolist() == [
+        datetime(2024, 3, 10, 1, 59), datetime(2024, 3, 10, 3, 0),
+    ]
+    # UTC 21:00~22:00：切换前是当地 16:00~17:00（日间），切换后是 17:00~18:00（晚间）
+    starts = [datetime(2024, 3, 9, 21), datetime(2024, 3, 11, 21)]
+    ends = [datetime(2024, 3, 9, 22), datetime(2024, 3, 11, 22)]
+    assert shifts.classify(starts, ends, tz=tz).tolist() == [shifts.REGULAR, shifts.LATE]
+    # 上海 1988 年实行过夏令时
+    assert shifts.to_local([datetime(1988, 7, 1)], ZoneInfo('Asia/Shanghai')).tolist() == [datetime(1988, 7, 1, 9)]
@@ -0,0 +1,25 @@
+"""user_summary 未建立时只关闭首页汇总，不影响 balances 月度汇总"""
+
+import pytest
+
+
+@pytest.fixture
+def fresh_state(app_module, monkeypatch):
+    monkeypatch.setattr(app_module, '_balances_state', {'ready': False, 'summary': False})
+    return app_module
+
+
+def test_balances_without_summary_still_used(fresh_state):
+    # 加入 user_summary 之前建立的 balances
+    fresh_state.db['app']['meta'].insert_one({'_id': 'balances', 'built': True})
+    assert fresh_state.balances_ready()
+    assert not fresh_state.summary_ready()
+    assert fresh_state.get_user_summary('甲') is None
+
+
+def test_rebuild_enables_summary(fresh_state):
+    fresh_state.db['app']['meta'].insert_one({'_id': 'balances', 'built': True})
+    fresh_state.rebuild_balances()
+    assert fresh_state.balances_ready()
+    assert fresh_state.summary_ready()
+    assert fresh_state.get_user_summary('甲') == {'overtime': 0, 'compensation': 0, 'balance': 0, 'pending': 0}